@@ -4,19 +4,17 @@
 !pip install cairosvg
 
 import os
+import copy
 import re
 import logging
-import xml.etree.ElementTree as ET
+import lxml.etree as ET
 import cairosvg
 from pathlib import Path
 import pandas as pd
 from google.colab import drive
-import io
-import tempfile
 from IPython.display import display
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
 
 # Set up logging
@@ -46,30 +44,16 @@ def select_folder():
         else:
             print("Folder not found. Please try again.")
 
-def get_files_from_folder(folder_info):
-    """Get SVG files from the specified folder."""
-    folder_path = folder_info['path']
-    svg_files = []
-    svg_files = [
-        {'name': f, 'path': os.path.join(folder_path, f)}
-        for f in os.listdir(folder_path)
-        if f.lower().endswith('.svg')
-    ]
-    if not svg_files:
-        logger.error("No SVG files found in the selected folder.")
-    return svg_files
+def iter_svg_files(folder_path):
+    """Yield SVG files from the specified folder as they are enumerated."""
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith('.svg'):
+                yield {'name': entry.name, 'path': entry.path}
 
-def download_svg_file(file_info):
-    """Read an SVG file from the folder."""
-    try:
-        with open(file_info['path'], 'rb') as f:
-            return io.BytesIO(f.read())
-    except Exception as e:
-        logger.error(f"Error reading file: {str(e)}")
-        return None
-
-# Compile regex pattern once
+# Compile regex patterns once
 FILENAME_PATTERN = re.compile(r'([^-]+)\s*-\s*Week\s*(\d+)\s*-\s*([^-]+)\s*-\s*([^-]+)\s*-\s*Animal\s*(\d+)')
+DIMENSION_PATTERN = re.compile(r'[^0-9.]')
 
 def extract_metadata(filename):
     """Extract metadata from filename."""
@@ -88,6 +72,16 @@ def extract_metadata(filename):
         logger.warning(f"Filename format error: {filename}")
         return None
 
+def parse_dimension(value):
+    """Parse an SVG length such as '1024px' into an integer number of pixels."""
+    if value is None:
+        return None
+    value = DIMENSION_PATTERN.sub('', str(value))
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return None
+
 # Define namespaces at module level to avoid recreation
 NAMESPACES = {
     'svg': 'http://www.w3.org/2000/svg',
@@ -95,6 +89,33 @@ NAMESPACES = {
     'xlink': 'http://www.w3.org/1999/xlink'
 }
 
+# Embedded slide images are large base64 text nodes, which lxml rejects without huge_tree
+SVG_PARSER = ET.XMLParser(huge_tree=True)
+
+# Compile the layer lookups once and reuse them for every file
+IMAGE2_XPATH = ET.XPath(".//svg:image[@id='image2']", namespaces=NAMESPACES)
+ROI_XPATH = ET.XPath(".//svg:g[@id='g3']", namespaces=NAMESPACES)
+GRIDS_XPATH = ET.XPath(".//svg:g[@inkscape:label='Grids']", namespaces=NAMESPACES)
+ELEMENT_XPATHS = {'image2': IMAGE2_XPATH, 'g3': ROI_XPATH, 'Grids': GRIDS_XPATH}
+
+def svg_tag(name):
+    """Return the namespaced tag name for an SVG element."""
+    return f"{{{NAMESPACES['svg']}}}{name}"
+
+def render_svg_layer(svg_bytes, output_path, width, height):
+    """Rasterize a serialized SVG layer to a PNG file.
+
+    Runs inside the Step 1 worker processes, so rendering never contends for
+    the main interpreter's GIL.
+    """
+    cairosvg.svg2png(
+        bytestring=svg_bytes,
+        write_to=str(output_path),
+        output_width=width,
+        output_height=height,
+        dpi=250
+    )
+
 def process_single_element(element_info, root, width, height, base_name, output_dir, metadata):
     """Process a single SVG element."""
     elem_type, id_type, id_value, subdir, suffix, needs_background, meta_key = element_info
@@ -102,27 +123,24 @@ def process_single_element(element_info, root, width, height, base_name, output_
     stain_subdir = output_dir / subdir / metadata['Staining']
     stain_subdir.mkdir(parents=True, exist_ok=True)
 
-    new_root = ET.Element('svg')
-    new_root.set('xmlns', 'http://www.w3.org/2000/svg')
+    new_root = ET.Element(svg_tag('svg'), nsmap={None: NAMESPACES['svg'], 'xlink': NAMESPACES['xlink']})
     new_root.set('width', f'{width}px')
     new_root.set('height', f'{height}px')
     new_root.set('viewBox', f'0 0 {width} {height}')
 
-    if id_type == 'inkscape_label':
-        element = root.find(f".//svg:{elem_type}[@{{{NAMESPACES['inkscape']}}}label='{id_value}']", NAMESPACES)
-    else:
-        element = root.find(f".//svg:{elem_type}[@id='{id_value}']", NAMESPACES)
+    matches = ELEMENT_XPATHS[id_value](root)
+    element = matches[0] if matches else None
 
     if element is not None:
         if needs_background:
-            background = ET.SubElement(new_root, 'rect')
+            background = ET.SubElement(new_root, svg_tag('rect'))
             background.set('width', f'{width}px')
             background.set('height', f'{height}px')
             background.set('fill', 'white')
             background.set('x', '0')
             background.set('y', '0')
 
-        new_elem = ET.SubElement(new_root, elem_type)
+        new_elem = ET.SubElement(new_root, svg_tag(elem_type))
 
         if elem_type == 'image':
             # Special handling for image elements
@@ -139,7 +157,7 @@ def process_single_element(element_info, root, width, height, base_name, output_
 
             # Copy the image data and other attributes
             for attr, value in element.attrib.items():
-                if attr == '{http://www.w3.org/1999/xlink}href':
+                if attr == f"{{{NAMESPACES['xlink']}}}href":
                     new_elem.set(attr, value)
                 elif attr not in ['width', 'height', 'x', 'y', 'preserveAspectRatio']:
                     new_elem.set(attr, value)
@@ -152,24 +170,15 @@ def process_single_element(element_info, root, width, height, base_name, output_
                     new_elem.set(attr, value)
 
             # Copy all child elements for non-image elements
-            for child in element:
-                new_elem.append(ET.fromstring(ET.tostring(child)))
+            new_elem.extend(copy.deepcopy(list(element)))
 
-        with tempfile.NamedTemporaryFile(suffix='.svg', delete=False) as temp_svg:
-            tree = ET.ElementTree(new_root)
-            tree.write(temp_svg.name)
+        svg_bytes = ET.tostring(new_root, xml_declaration=False)
 
         output_filename = f"{base_name}{suffix}.png"
         output_path = stain_subdir / output_filename
 
         try:
-            cairosvg.svg2png(
-                file_obj=open(temp_svg.name, 'rb'),
-                write_to=str(output_path),
-                output_width=width,
-                output_height=height,
-                dpi=250
-            )
+            render_svg_layer(svg_bytes, output_path, width, height)
             result = {
                 'path': str(output_path.relative_to(output_dir)),
                 'dimensions': f"{width}x{height}",
@@ -179,22 +188,23 @@ def process_single_element(element_info, root, width, height, base_name, output_
             logger.error(f'Error converting to PNG: {str(e)}')
             result = {'path': "CONVERSION_ERROR", 'dimensions': None, 'status': 'ERROR'}
 
-        os.unlink(temp_svg.name)
         return id_value, result
     return id_value, {'path': "MISSING", 'dimensions': None, 'status': 'MISSING'}
 
-def process_svg_file(svg_content, filename, output_dir):
-    """Process a single SVG file and extract layers."""
+def process_svg_file(svg_path, filename, output_dir):
+    """Read and process a single SVG file and extract layers."""
     base_name = Path(filename).stem
     metadata = extract_metadata(base_name)
     if not metadata:
         return None
 
     try:
-        tree = ET.parse(io.BytesIO(svg_content.getvalue()))
-        root = tree.getroot()
+        # One large read instead of libxml2's small chunked reads on the Drive mount
+        with open(svg_path, 'rb') as f:
+            root = ET.fromstring(f.read(), SVG_PARSER)
 
-        original_image = root.find(f".//svg:image[@id='image2']", NAMESPACES)
+        matches = IMAGE2_XPATH(root)
+        original_image = matches[0] if matches else None
         if original_image is None:
             logger.error(f"Original image (image2) not found in {filename}. Cannot proceed.")
             return None
@@ -215,15 +225,6 @@ def process_svg_file(svg_content, filename, output_dir):
 
         # If viewBox dimensions aren't available, fall back to image dimensions
         if not width or not height:
-            def parse_dimension(value):
-                if value is None:
-                    return None
-                value = re.sub(r'[^0-9.]', '', str(value))
-                try:
-                    return int(float(value))
-                except (ValueError, TypeError):
-                    return None
-
             width = parse_dimension(original_image.get('width'))
             height = parse_dimension(original_image.get('height'))
 
@@ -244,15 +245,12 @@ def process_svg_file(svg_content, filename, output_dir):
             ('g', 'inkscape_label', 'Grids', 'Grid-Images', ' (Grid)', True, 'GridPath')
         ]
 
-        with ThreadPoolExecutor() as executor:
-            process_func = partial(process_single_element, root=root, width=width, height=height,
-                                 base_name=base_name, output_dir=output_dir, metadata=metadata)
-            futures = [executor.submit(process_func, element_info) for element_info in elements_to_process]
-
-            results = {}
-            for future in as_completed(futures):
-                id_value, result = future.result()
-                results[id_value] = result
+        # Only three layers per file; files are already parallelized in main()
+        results = {}
+        for element_info in elements_to_process:
+            id_value, result = process_single_element(element_info, root, width, height,
+                                                      base_name, output_dir, metadata)
+            results[id_value] = result
 
         # Update metadata with results
         all_missing = True
@@ -301,36 +299,31 @@ def main():
     output_dir = Path(folder_info['path'])
     logger.info(f"Selected folder: {folder_info['name']}")
 
-    svg_files = get_files_from_folder(folder_info)
-    if not svg_files:
-        logger.error("No SVG files found for processing!")
-        return
-
     metadata_list = []
     files_with_issues = []
 
-    # Calculate optimal number of workers based on CPU cores
-    max_workers = min(32, (multiprocessing.cpu_count() * 2))
-
-    # Process files in parallel using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # Process files in parallel using ProcessPoolExecutor; parsing and rasterization
+    # are CPU-bound and hold the GIL, so each worker reads and renders its own file
+    with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        # Submit while the folder is enumerated so workers start on the first files
         future_to_file = {
-            executor.submit(download_svg_file, file): file
-            for file in svg_files
+            executor.submit(process_svg_file, file['path'], file['name'], output_dir): file
+            for file in iter_svg_files(folder_info['path'])
         }
+        if not future_to_file:
+            logger.error("No SVG files found for processing!")
+            return
 
         # Use tqdm to show progress
-        with tqdm(total=len(svg_files), desc="Processing SVG files") as pbar:
+        with tqdm(total=len(future_to_file), desc="Processing SVG files") as pbar:
             for future in as_completed(future_to_file):
                 file = future_to_file[future]
-                svg_content = future.result()
+                metadata = future.result()
 
-                if svg_content:
-                    metadata = process_svg_file(svg_content, file['name'], output_dir)
-                    if metadata:
-                        metadata_list.append(metadata)
-                        if metadata['processing_status'] != "SUCCESS":
-                            files_with_issues.append((file['name'], metadata['processing_status']))
+                if metadata:
+                    metadata_list.append(metadata)
+                    if metadata['processing_status'] != "SUCCESS":
+                        files_with_issues.append((file['name'], metadata['processing_status']))
 
                 pbar.update(1)
 
@@ -370,7 +363,6 @@ if __name__ == "__main__":
 import cv2
 import numpy as np
 from pathlib import Path
-import matplotlib.pyplot as plt
 import logging
 import pandas as pd
 import os
@@ -379,6 +371,16 @@ from google.colab import drive
 import re
 import gc
 import psutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# pyvips decodes large PNGs faster than cv2.imread; fall back to OpenCV without it
+try:
+    import pyvips
+    # basicConfig below enables INFO, which would log a libvips threadpool message per decode
+    logging.getLogger('pyvips').setLevel(logging.WARNING)
+except ImportError:
+    pyvips = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -390,132 +392,114 @@ def log_memory():
     memory_mb = process.memory_info().rss / 1024 / 1024
     logger.info(f"Memory usage: {memory_mb:.2f} MB")
 
+# Compile regex pattern once
+SANITIZE_PATTERN = re.compile(r'[^\w\-_\. ]')
+
+def read_color_image(path):
+    """Read an image as 8-bit BGR, using pyvips when available."""
+    if pyvips is not None:
+        try:
+            image = pyvips.Image.new_from_file(str(path), access='sequential')
+            if image.format == 'uchar':
+                array = np.ndarray(
+                    buffer=image.write_to_memory(),
+                    dtype=np.uint8,
+                    shape=[image.height, image.width, image.bands]
+                )
+                # Match cv2.imread: drop alpha and return BGR channel order
+                if image.bands >= 3:
+                    return np.ascontiguousarray(array[:, :, 2::-1])
+                return cv2.cvtColor(array[:, :, 0], cv2.COLOR_GRAY2BGR)
+        except pyvips.Error as e:
+            logger.warning(f"pyvips could not decode {path}, using OpenCV: {e}")
+    return cv2.imread(str(path))
+
 def sanitize_filename(name):
     """Sanitize filename by removing invalid characters."""
-    return re.sub(r'[^\w\-_\. ]', '_', name)
+    return SANITIZE_PATTERN.sub('_', name)
 
-def create_roi_mask(roi_image):
-    """Create mask from ROI image with black contour on white background."""
+def create_roi_mask(roi_gray):
+    """Create mask from grayscale ROI image with black contour on white background."""
     try:
-        # Convert to grayscale if needed
-        if len(roi_image.shape) == 3:
-            roi_gray = cv2.cvtColor(roi_image, cv2.COLOR_BGR2GRAY)
-            del roi_image  # Immediate cleanup
-        else:
-            roi_gray = roi_image.copy()
-            del roi_image
-
         # Use adaptive thresholding for better results
         binary = cv2.adaptiveThreshold(
             roi_gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
             cv2.THRESH_BINARY_INV, 11, 2
         )
-        del roi_gray  # Cleanup grayscale image
 
         # Find contours
         contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         mask = np.zeros_like(binary)
-        del binary  # Cleanup binary image
 
         if contours:
             cv2.drawContours(mask, contours, -1, (255), thickness=cv2.FILLED)
         else:
             logger.warning("No contours found in ROI image.")
 
-        del contours  # Cleanup contours
         return mask
     except Exception as e:
         logger.error(f"Error in create_roi_mask: {e}")
         return None
-    finally:
-        gc.collect()
 
 def apply_roi_mask(original_image, mask):
     """Apply ROI mask to original image."""
     try:
-        # Ensure mask is binary
-        mask_binary = mask.astype(bool)
-        del mask  # Original mask no longer needed
-
-        # Create result array
-        result = np.full_like(original_image, 255)
-
-        # Apply mask
-        result[mask_binary] = original_image[mask_binary]
-        del mask_binary  # Cleanup mask
-
-        return result
+        # Keep pixels inside the mask, white everywhere else, in a single pass
+        return np.where(mask.astype(bool)[:, :, None], original_image, np.uint8(255))
     except Exception as e:
         logger.error(f"Error in apply_roi_mask: {e}")
         return None
-    finally:
-        gc.collect()
 
-def visualize_roi_process(roi_image, original_image, result, output_path):
-    """Visualize original, ROI, and masked result and save to file."""
+def visualize_roi_process(roi_image, original_image, result, output_path, panel_height=1250):
+    """Visualize original, ROI, and masked result side by side and save to file."""
     try:
-        plt.close('all')  # Ensure all previous plots are closed
-        fig, axs = plt.subplots(1, 3, figsize=(15, 5))
-
-        # Process one image at a time
-        # Original image
-        rgb_original = cv2.cvtColor(original_image, cv2.COLOR_BGR2RGB)
-        axs[0].imshow(rgb_original)
-        axs[0].set_title('Original Image')
-        axs[0].axis('off')
-        del rgb_original
-
-        # ROI contour
-        rgb_roi = cv2.cvtColor(roi_image, cv2.COLOR_BGR2RGB)
-        axs[1].imshow(rgb_roi)
-        axs[1].set_title('ROI Contour')
-        axs[1].axis('off')
-        del rgb_roi
-
-        # Final masked result
-        rgb_result = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
-        axs[2].imshow(rgb_result)
-        axs[2].set_title('Masked Result')
-        axs[2].axis('off')
-        del rgb_result
-
-        plt.tight_layout()
-        plt.savefig(str(output_path), bbox_inches='tight', dpi=250)
+        # Downscale each panel so the strip stays a preview regardless of slide size
+        height, width = original_image.shape[:2]
+        scale = min(1.0, panel_height / height)
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        panels = [cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                  for image in (original_image, roi_image, result)]
+        # The ROI image is loaded as grayscale; expand only the downscaled panel
+        panels = [cv2.cvtColor(p, cv2.COLOR_GRAY2BGR) if p.ndim == 2 else p for p in panels]
+
+        panel = cv2.hconcat(panels)
+        font_scale = max(1.0, size[1] / 500)
+        thickness = max(2, int(font_scale * 2))
+        for i, title in enumerate(['Original Image', 'ROI Contour', 'Masked Result']):
+            cv2.putText(panel, title, (i * size[0] + 10, int(30 * font_scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 255), thickness)
+
+        cv2.imwrite(str(output_path), panel)
     except Exception as e:
         logger.error(f"Error in visualize_roi_process: {e}")
-    finally:
-        plt.close('all')
-        gc.collect()
 
 def process_single_image(orig_path, roi_path, filename):
     """Process a single image pair."""
     try:
         # Read images one at a time
-        orig_img = cv2.imread(str(orig_path))
+        orig_img = read_color_image(orig_path)
         if orig_img is None:
             logger.error(f"Failed to read original image: {filename}")
             return None, None, None
 
-        roi_img = cv2.imread(str(roi_path))
+        # The ROI contour is only needed as grayscale
+        roi_img = cv2.imread(str(roi_path), cv2.IMREAD_GRAYSCALE)
         if roi_img is None:
             logger.error(f"Failed to read ROI image: {filename}")
-            del orig_img
             return None, None, None
 
         # Check sizes
-        if orig_img.shape != roi_img.shape:
+        if orig_img.shape[:2] != roi_img.shape:
             logger.error(f"Size mismatch: Original {orig_img.shape} vs ROI {roi_img.shape} for {filename}")
             return None, None, None
 
         # Create mask
-        mask = create_roi_mask(roi_img.copy())
+        mask = create_roi_mask(roi_img)
         if mask is None:
             return None, None, None
 
         # Apply mask
         result = apply_roi_mask(orig_img, mask)
-        del mask  # Cleanup mask
-
         if result is None:
             return None, None, None
 
@@ -523,13 +507,35 @@ def process_single_image(orig_path, roi_path, filename):
     except Exception as e:
         logger.error(f"Error in process_single_image for {filename}: {e}")
         return None, None, None
-    finally:
-        gc.collect()
+
+def init_worker():
+    """Limit each pool worker to one OpenCV thread so workers do not oversubscribe the CPUs."""
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(1)
+
+def process_and_save_image(job):
+    """Mask a single image pair and save the result and its visualization.
+
+    Runs in a worker process; returns the output paths, or None paths on failure.
+    """
+    idx, orig_path, roi_path, output_path, vis_output_path, filename = job
+    try:
+        orig_img, roi_img, result = process_single_image(orig_path, roi_path, filename)
+        if result is None:
+            return idx, None, None
+
+        cv2.imwrite(str(output_path), result)
+        visualize_roi_process(roi_img, orig_img, result, vis_output_path)
+        return idx, output_path, vis_output_path
+    except Exception as e:
+        logger.error(f"Error in process_and_save_image for {filename}: {e}")
+        return idx, None, None
 
 def process_staining_group(stain_df, base_path, output_dir, vis_dir, metadata_df):
     """Process a group of images with the same staining."""
     try:
-        for idx in tqdm(stain_df.index, desc=f"Processing {stain_df.iloc[0]['Staining']} images"):
+        jobs = []
+        for idx in stain_df.index:
             row = stain_df.loc[idx]
 
             # Check if files exist
@@ -540,45 +546,44 @@ def process_staining_group(stain_df, base_path, output_dir, vis_dir, metadata_df
                 logger.warning(f"Missing files for {row['Filename']}")
                 continue
 
-            # Process single image pair
-            orig_img, roi_img, result = process_single_image(orig_path, roi_path, row['Filename'])
+            # Create output filenames
+            output_name = f"{row['Condition']}_Week{row['Week']}_{row['Staining']}_{row['Location']}_Animal{row['Animal']}_masked.png"
+            output_name = sanitize_filename(output_name)
+            vis_output_name = output_name.replace('.png', '_visualization.png')
 
-            if result is not None:
-                try:
-                    # Create output filename
-                    output_name = f"{row['Condition']}_Week{row['Week']}_{row['Staining']}_{row['Location']}_Animal{row['Animal']}_masked.png"
-                    output_name = sanitize_filename(output_name)
-                    output_path = output_dir / output_name
-
-                    # Save result
-                    cv2.imwrite(str(output_path), result)
-
-                    # Create and save visualization
-                    vis_output_name = output_name.replace('.png', '_visualization.png')
-                    vis_output_path = vis_dir / vis_output_name
-                    visualize_roi_process(roi_img, orig_img, result, vis_output_path)
-
-                    # Update metadata
-                    metadata_df.at[idx, 'MaskedPath'] = str(output_path.relative_to(base_path))
-                    metadata_df.at[idx, 'ROIVisualizationPath'] = str(vis_output_path.relative_to(base_path))
-
-                    logger.info(f"Processed {output_name}")
-                finally:
-                    # Cleanup
-                    del orig_img, roi_img, result
-                    gc.collect()
-            else:
-                logger.error(f"Processing failed for {row['Filename']}")
+            jobs.append((idx, orig_path, roi_path, output_dir / output_name,
+                         vis_dir / vis_output_name, row['Filename']))
 
-            # Log memory usage periodically
-            if idx % 5 == 0:
-                log_memory()
+        # Images are independent; mask and save them in parallel worker processes
+        updates = []
+        with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count(), initializer=init_worker) as executor:
+            futures = [executor.submit(process_and_save_image, job) for job in jobs]
+
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc=f"Processing {stain_df.iloc[0]['Staining']} images"):
+                idx, output_path, vis_output_path = future.result()
+
+                if output_path is None:
+                    logger.error(f"Processing failed for {stain_df.at[idx, 'Filename']}")
+                    continue
+
+                updates.append((idx,
+                                str(output_path.relative_to(base_path)),
+                                str(vis_output_path.relative_to(base_path))))
+                logger.info(f"Processed {output_path.name}")
+
+                # Log memory usage periodically
+                if idx % 5 == 0:
+                    log_memory()
+
+        # Update metadata in one assignment per column
+        if updates:
+            idxs, masked_paths, vis_paths = zip(*updates)
+            metadata_df.loc[list(idxs), 'MaskedPath'] = list(masked_paths)
+            metadata_df.loc[list(idxs), 'ROIVisualizationPath'] = list(vis_paths)
 
     except Exception as e:
         logger.error(f"Error in process_staining_group: {e}")
-    finally:
-        plt.close('all')
-        gc.collect()
 
 def process_all_images_from_metadata(drive_folder_path):
     """Process all images using metadata CSV file."""
@@ -628,10 +633,7 @@ def process_all_images_from_metadata(drive_folder_path):
                 # Process staining group
                 process_staining_group(stain_df, base_path, stain_output_dir, stain_vis_dir, metadata_df)
 
-                # Save progress after each staining type
-                metadata_df.to_csv(metadata_path, index=False)
-
-                # Cleanup
+                # Release the stain group before moving on
                 del stain_df
                 gc.collect()
                 log_memory()
@@ -640,14 +642,14 @@ def process_all_images_from_metadata(drive_folder_path):
                 logger.error(f"Error processing staining type {stain}: {e}")
                 continue
 
+        # Save results once all staining types are processed
+        metadata_df.to_csv(metadata_path, index=False)
+
         return metadata_path
 
     except Exception as e:
         logger.error(f"Error in process_all_images_from_metadata: {e}")
         return None
-    finally:
-        plt.close('all')
-        gc.collect()
 
 def main():
     try:
@@ -680,9 +682,6 @@ def main():
 
     except Exception as e:
         logger.error(f"Error in main: {e}")
-    finally:
-        plt.close('all')
-        gc.collect()
 
 if __name__ == "__main__":
     main()
@@ -693,7 +692,6 @@ if __name__ == "__main__":
 import cv2
 import numpy as np
 from pathlib import Path
-import matplotlib.pyplot as plt
 import logging
 import pandas as pd
 import os
@@ -702,7 +700,15 @@ from google.colab import drive
 import gc
 import psutil
 import platform
-import time
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Numba compiles the Hough line classification loop when it is installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -714,51 +720,54 @@ def log_memory():
     memory_mb = process.memory_info().rss / 1024 / 1024
     logger.info(f"Memory usage: {memory_mb:.2f} MB")
 
-def enhance_grid_lines(grid_image):
-    """Enhance grid lines using multiple preprocessing techniques."""
+# Tiles stay lossless PNG for Step 3 but use fast zlib; visualizations are previews only
+TILE_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+VIS_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85]
+
+# Panels per row of a tiling visualization, keeping it well inside JPEG's 65500 px limit
+VIS_GRID_COLUMNS = 10
+
+# Longest side of the ROI area preview, the size of the former 10 inch figure at 250 dpi
+AREA_PREVIEW_SIZE = 2500
+
+# Grid lines are detected on a half-resolution grayscale decode of the grid image
+GRID_READ_FLAG = cv2.IMREAD_REDUCED_GRAYSCALE_2
+GRID_SCALE = 2
+
+def enhance_grid_lines(grid_image, strict=False):
+    """Enhance grid lines using adaptive thresholding and edge detection.
+
+    With strict=True, the finer adaptive threshold and fixed thresholds are
+    also OR'd in for grid images where the default passes miss lines.
+    """
     try:
         if len(grid_image.shape) == 3:
             gray = cv2.cvtColor(grid_image, cv2.COLOR_BGR2GRAY)
         else:
-            gray = grid_image.copy()
-
-        combined = np.zeros_like(gray)
+            gray = grid_image
 
-        # Process methods one at a time to save memory
-        # Method 1: Adaptive thresholding
-        adaptive1 = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV, 11, 2
-        )
-        combined = cv2.bitwise_or(combined, adaptive1)
-        del adaptive1
-
-        # Method 2: Different adaptive parameters
-        adaptive2 = cv2.adaptiveThreshold(
+        # Adaptive thresholding recovers the grid strokes, Canny their edges
+        adaptive = cv2.adaptiveThreshold(
             gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
             cv2.THRESH_BINARY_INV, 21, 4
         )
-        combined = cv2.bitwise_or(combined, adaptive2)
-        del adaptive2
+        combined = cv2.bitwise_or(adaptive, cv2.Canny(gray, 50, 150))
 
-        # Method 3: Edge detection
-        edges = cv2.Canny(gray, 50, 150)
-        combined = cv2.bitwise_or(combined, edges)
-        del edges
+        if strict:
+            fine = cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY_INV, 11, 2
+            )
+            combined = cv2.bitwise_or(combined, fine)
 
-        # Method 4: Multiple thresholds
-        for thresh in [50, 100, 150]:
-            _, binary = cv2.threshold(gray, thresh, 255, cv2.THRESH_BINARY_INV)
-            combined = cv2.bitwise_or(combined, binary)
-            del binary
+            for thresh in [50, 100, 150]:
+                _, binary = cv2.threshold(gray, thresh, 255, cv2.THRESH_BINARY_INV)
+                combined = cv2.bitwise_or(combined, binary)
 
-        del gray
         return combined
     except Exception as e:
         logger.error(f"Error in enhance_grid_lines: {e}")
         return None
-    finally:
-        gc.collect()
 
 def cluster_lines(lines, tolerance=20, filename=None):
     """Cluster nearby lines."""
@@ -768,67 +777,77 @@ def cluster_lines(lines, tolerance=20, filename=None):
         return []
 
     try:
-        lines = np.array(sorted(lines))
-        clusters = []
-        current_cluster = [lines[0]]
+        lines = np.sort(np.asarray(lines, dtype=float))
 
-        for line in lines[1:]:
-            if line - current_cluster[-1] <= tolerance:
-                current_cluster.append(line)
-            else:
-                clusters.append(int(np.mean(current_cluster)))
-                current_cluster = [line]
-
-        if current_cluster:
-            clusters.append(int(np.mean(current_cluster)))
+        # A new cluster starts wherever the gap to the previous line exceeds the tolerance
+        cluster_ids = np.cumsum(np.r_[0, np.diff(lines) > tolerance])
+        cluster_means = np.bincount(cluster_ids, weights=lines) / np.bincount(cluster_ids)
 
-        return sorted(clusters)
+        return cluster_means.astype(int).tolist()
     except Exception as e:
         logger.error(f"Error in cluster_lines: {e}")
         return []
-    finally:
-        gc.collect()
 
-def detect_grid_lines(grid_image, min_line_length_ratio=0.3, filename=None):
+if njit is not None:
+    @njit
+    def classify_lines(lines_xy, angle_threshold):
+        """Split (N, 4) Hough segments into horizontal y and vertical x midpoints."""
+        n = lines_xy.shape[0]
+        h = np.empty(n)
+        v = np.empty(n)
+        nh = 0
+        nv = 0
+        for i in range(n):
+            x1, y1, x2, y2 = lines_xy[i, 0], lines_xy[i, 1], lines_xy[i, 2], lines_xy[i, 3]
+            angle = abs(math.degrees(math.atan2(y2 - y1, x2 - x1)))
+            if angle < angle_threshold or angle > 180 - angle_threshold:
+                h[nh] = (y1 + y2) / 2
+                nh += 1
+            elif abs(angle - 90) < angle_threshold:
+                v[nv] = (x1 + x2) / 2
+                nv += 1
+        return h[:nh], v[:nv]
+else:
+    def classify_lines(lines_xy, angle_threshold):
+        """Split (N, 4) Hough segments into horizontal y and vertical x midpoints."""
+        x1, y1, x2, y2 = lines_xy.T
+        angles = np.abs(np.degrees(np.arctan2(y2 - y1, x2 - x1)))
+
+        h_mask = (angles < angle_threshold) | (angles > 180 - angle_threshold)
+        v_mask = ~h_mask & (np.abs(angles - 90) < angle_threshold)
+
+        return ((y1 + y2) / 2)[h_mask], ((x1 + x2) / 2)[v_mask]
+
+def detect_grid_lines(grid_image, min_line_length_ratio=0.3, filename=None, strict=False):
     """Detect grid lines with adaptive parameters."""
     try:
         height, width = grid_image.shape[:2]
         min_line_length = min(height, width) * min_line_length_ratio
 
         # Enhance grid lines
-        enhanced = enhance_grid_lines(grid_image)
+        enhanced = enhance_grid_lines(grid_image, strict=strict)
         if enhanced is None:
             return [], [], None
 
-        # Process lines in batches to save memory
         h_lines = []
         v_lines = []
         angle_threshold = 20
 
-        for threshold in [50, 100, 150]:
-            for min_gap in [5, 10, 20]:
-                lines = cv2.HoughLinesP(
-                    enhanced,
-                    rho=1,
-                    theta=np.pi/180,
-                    threshold=threshold,
-                    minLineLength=min_line_length,
-                    maxLineGap=min_gap
-                )
-
-                if lines is not None:
-                    for line in lines:
-                        x1, y1, x2, y2 = line[0]
-                        angle = abs(np.degrees(np.arctan2(y2 - y1, x2 - x1)))
-
-                        if angle < angle_threshold or angle > 180 - angle_threshold:
-                            h_lines.append((y1 + y2) / 2)
-                        elif abs(angle - 90) < angle_threshold:
-                            v_lines.append((x1 + x2) / 2)
-
-                    del lines
+        # Single pass at the most permissive settings; near-duplicate lines are
+        # merged by the clustering step below
+        lines = cv2.HoughLinesP(
+            enhanced,
+            rho=1,
+            theta=np.pi/180,
+            threshold=50,
+            minLineLength=min_line_length,
+            maxLineGap=20
+        )
 
-        del enhanced
+        if lines is not None:
+            h_mid, v_mid = classify_lines(lines.reshape(-1, 4).astype(np.float64), angle_threshold)
+            h_lines = h_mid.tolist()
+            v_lines = v_mid.tolist()
 
         # Cluster lines
         h_clusters = cluster_lines(h_lines, filename=filename)
@@ -848,59 +867,59 @@ def detect_grid_lines(grid_image, min_line_length_ratio=0.3, filename=None):
     except Exception as e:
         logger.error(f"Error in detect_grid_lines for {filename}: {e}")
         return [], [], None
-    finally:
-        gc.collect()
 
-def create_tiles_from_masked(masked_image, h_lines, v_lines):
-    """Create tiles from masked image using detected grid lines."""
+def create_tiles_from_masked(masked_image, gray, h_lines, v_lines, tiles_dir, stem, preview_size=512):
+    """Create tiles from masked image using detected grid lines and save each one as it is accepted.
+
+    Returns the saved tile paths and small previews of the tiles for visualization.
+    """
     try:
         height, width = masked_image.shape[:2]
 
         # Add boundaries
-        h_lines = sorted([0] + list(h_lines) + [height])
-        v_lines = sorted([0] + list(v_lines) + [width])
+        hs = np.clip(np.array(sorted([0] + list(h_lines) + [height])), 0, height).astype(int)
+        vs = np.clip(np.array(sorted([0] + list(v_lines) + [width])), 0, width).astype(int)
 
-        tiles = []
+        tile_paths = []
+        previews = []
         min_tile_size = 50
         min_content_ratio = 0.1
 
-        # Process one tile at a time
-        for i in range(len(h_lines) - 1):
-            for j in range(len(v_lines) - 1):
-                y1, y2 = int(h_lines[i]), int(h_lines[i + 1])
-                x1, x2 = int(v_lines[j]), int(v_lines[j + 1])
+        # Filter undersized tiles over the whole boundary grid at once
+        dh = np.diff(hs)
+        dv = np.diff(vs)
+        ok_size = (dh[:, None] >= min_tile_size) & (dv[None, :] >= min_tile_size)
 
-                # Extract tile
-                tile = masked_image[y1:y2, x1:x2].copy()
+        # Integral image of non-white pixels, built once per masked image from the
+        # same grayscale used for the ROI area
+        _, non_white = cv2.threshold(gray, 254, 1, cv2.THRESH_BINARY_INV)
+        integral = cv2.integral(non_white)
 
-                # Check size
-                if tile.shape[0] < min_tile_size or tile.shape[1] < min_tile_size:
-                    del tile
-                    continue
+        # Content ratio of every tile from four corner lookups
+        y1, y2 = hs[:-1, None], hs[1:, None]
+        x1, x2 = vs[None, :-1], vs[None, 1:]
+        content = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+        areas = np.maximum(dh[:, None] * dv[None, :], 1)
+        ok_content = content / areas > min_content_ratio
 
-                # Check content
-                if len(tile.shape) == 3:
-                    non_white = np.any(tile != [255, 255, 255], axis=2)
-                else:
-                    non_white = tile != 255
+        # Only visit tiles that passed both checks and write each one straight away
+        for tile_idx, (i, j) in enumerate(np.argwhere(ok_size & ok_content), 1):
+            tile = masked_image[hs[i]:hs[i + 1], vs[j]:vs[j + 1]]
 
-                content_ratio = np.mean(non_white)
-                del non_white
+            output_path = tiles_dir / f"{stem} - {tile_idx}.png"
+            cv2.imwrite(str(output_path), tile, TILE_PNG_PARAMS)
+            tile_paths.append(output_path)
 
-                if content_ratio > min_content_ratio:
-                    tiles.append(tile)
-                else:
-                    del tile
+            scale = min(1.0, preview_size / max(tile.shape[:2]))
+            previews.append(cv2.resize(tile, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
 
-        return tiles
+        return tile_paths, previews
 
     except Exception as e:
         logger.error(f"Error in create_tiles_from_masked: {e}")
-        return []
-    finally:
-        gc.collect()
+        return [], []
 
-def calculate_roi_area(masked_image, h_lines, v_lines, grid_spacing_microns=500):
+def calculate_roi_area(masked_image, gray, h_lines, v_lines, grid_spacing_microns=500):
     """Calculate the area of the ROI using grid lines as scale reference."""
     try:
         # Calculate grid sizes
@@ -920,16 +939,10 @@ def calculate_roi_area(masked_image, h_lines, v_lines, grid_spacing_microns=500)
         # Clean up spacing arrays
         del h_spaces, v_spaces, valid_h_spaces, valid_v_spaces
 
-        # Create ROI mask
-        if len(masked_image.shape) == 3:
-            gray = cv2.cvtColor(masked_image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = masked_image.copy()
-
-        roi_mask = (gray < 255).astype(np.uint8)
-        del gray
+        # Create ROI mask from the grayscale image computed once per file
+        _, roi_mask = cv2.threshold(gray, 254, 1, cv2.THRESH_BINARY_INV)
 
-        pixel_count = np.count_nonzero(roi_mask)
+        pixel_count = cv2.countNonZero(roi_mask)
         area_sq_microns = pixel_count * (microns_per_pixel ** 2)
 
         # Create visualization
@@ -956,125 +969,142 @@ def calculate_roi_area(masked_image, h_lines, v_lines, grid_spacing_microns=500)
     except Exception as e:
         logger.error(f"Error in calculate_roi_area: {e}")
         return None, None
-    finally:
-        gc.collect()
 
-def visualize_tile_process(masked_img, debug_img, tiles, metadata_row, vis_dir):
-    """Visualize original image, grid lines, and all tiles."""
-    try:
-        plt.close('all')
-        n_total = 2 + len(tiles)
-        fig, axs = plt.subplots(1, n_total, figsize=(5 * min(n_total, 10), 5))
-
-        # Process one image at a time
-        rgb_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2RGB)
-        axs[0].imshow(rgb_img)
-        axs[0].set_title('Original Masked Image')
-        axs[0].axis('off')
-        del rgb_img
-
-        axs[1].imshow(debug_img)
-        axs[1].set_title('Detected Grid')
-        axs[1].axis('off')
-
-        for idx, tile in enumerate(tiles):
-            tile_rgb = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
-            axs[idx + 2].imshow(tile_rgb)
-            axs[idx + 2].set_title(f'Tile {idx + 1}')
-            axs[idx + 2].axis('off')
-            del tile_rgb
+def add_title_bar(panel, title, bar_height=40):
+    """Return the panel with a white title bar added above it."""
+    titled = cv2.copyMakeBorder(panel, bar_height, 0, 0, 0, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    cv2.putText(titled, title, (10, int(bar_height * 0.7)), cv2.FONT_HERSHEY_SIMPLEX,
+                bar_height / 50, (0, 0, 0), 2)
+    return titled
 
-        plt.tight_layout()
-        vis_path = vis_dir / f"{Path(metadata_row['Filename']).stem}_grid_visualization.png"
-        plt.savefig(str(vis_path), bbox_inches='tight', dpi=250)
-
-        # Clean up plot objects
-        plt.close(fig)
-        del fig, axs
+def visualize_tile_process(masked_img, debug_img, tiles, metadata_row, vis_dir, panel_height=512):
+    """Visualize original image, grid lines, and all tiles (or their previews); returns the saved path or None."""
+    try:
+        # debug_img is RGB; everything else is BGR as read by OpenCV
+        images = [masked_img, cv2.cvtColor(debug_img, cv2.COLOR_RGB2BGR)] + list(tiles)
+        titles = ['Original Masked Image', 'Detected Grid'] + [f'Tile {idx + 1}' for idx in range(len(tiles))]
+
+        # Bring every panel to a common height
+        panels = []
+        for image, title in zip(images, titles):
+            height, width = image.shape[:2]
+            size = (max(1, int(width * panel_height / height)), panel_height)
+            panels.append(add_title_bar(cv2.resize(image, size, interpolation=cv2.INTER_AREA), title))
+
+        # Lay the panels out in rows of VIS_GRID_COLUMNS, padding each row to the widest one
+        rows = [cv2.hconcat(panels[start:start + VIS_GRID_COLUMNS])
+                for start in range(0, len(panels), VIS_GRID_COLUMNS)]
+        grid_width = max(row.shape[1] for row in rows)
+        rows = [cv2.copyMakeBorder(row, 0, 0, 0, grid_width - row.shape[1], cv2.BORDER_CONSTANT,
+                                   value=(255, 255, 255)) for row in rows]
+
+        vis_path = vis_dir / f"{Path(metadata_row['Filename']).stem}_grid_visualization.jpg"
+        # imwrite reports failure (e.g. an image too large for JPEG) by returning False
+        if not cv2.imwrite(str(vis_path), cv2.vconcat(rows), VIS_JPEG_PARAMS):
+            logger.error(f"Could not write visualization for {metadata_row['Filename']}")
+            return None
+        return vis_path
 
     except Exception as e:
         logger.error(f"Error in visualization for {metadata_row['Filename']}: {e}")
-    finally:
-        plt.close('all')
-        gc.collect()
+        return None
 
 def process_single_image(masked_path, grid_path, metadata_row, base_path, vis_dir, tiles_dir):
     """Process a single image and its grid."""
     try:
-        # Read images
-        masked_img = cv2.imread(str(masked_path))
-        grid_img = cv2.imread(str(grid_path))
+        # Read images; tiles are cut from the full-resolution masked image, but the
+        # grid is only needed at reduced resolution for line detection. imread
+        # releases the GIL, so the grid decodes while the masked image is read
+        with ThreadPoolExecutor(max_workers=1) as io_pool:
+            grid_future = io_pool.submit(cv2.imread, str(grid_path), GRID_READ_FLAG)
+            masked_img = cv2.imread(str(masked_path))
+            grid_img = grid_future.result()
 
         if masked_img is None or grid_img is None:
             logger.error(f"Failed to read images for {metadata_row['Filename']}")
             return None
 
-        if masked_img.shape[:2] != grid_img.shape[:2]:
+        height, width = masked_img.shape[:2]
+        if (height // GRID_SCALE, width // GRID_SCALE) != grid_img.shape[:2]:
             logger.error(f"Size mismatch for {metadata_row['Filename']}")
             return None
 
-        # Detect grid lines and get visualization
+        # Detect grid lines and get visualization, then map lines back to full resolution
         h_lines, v_lines, debug_img = detect_grid_lines(grid_img, filename=metadata_row['Filename'])
+        if not h_lines or not v_lines:
+            # Retry with the extra threshold passes only for the grids the default passes miss
+            logger.info(f"Retrying grid detection with strict thresholds for {metadata_row['Filename']}")
+            h_lines, v_lines, debug_img = detect_grid_lines(grid_img, filename=metadata_row['Filename'], strict=True)
         if not h_lines or not v_lines:
             return None
+        h_lines = [y * GRID_SCALE for y in h_lines]
+        v_lines = [x * GRID_SCALE for x in v_lines]
+
+        # Grayscale is shared by the ROI area and tile content checks
+        gray = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
 
         # Calculate ROI area
-        area_sq_microns, area_vis = calculate_roi_area(masked_img, h_lines, v_lines)
+        area_sq_microns, area_vis = calculate_roi_area(masked_img, gray, h_lines, v_lines)
         if area_sq_microns is None:
             return None
 
         del grid_img
-        gc.collect()
 
-        # Save area visualization
-        try:
-            plt.figure(figsize=(10, 10))
-            plt.imshow(area_vis)
-            plt.title(f"ROI Area Measurement\nArea: {area_sq_microns/1e6:.2f} mm²")
-            plt.axis('off')
-            plt.savefig(
-                str(vis_dir / f"{Path(metadata_row['Filename']).stem}_area_measurement.png"),
-                bbox_inches='tight',
-                dpi=250
-            )
-        finally:
-            plt.close()
-            del area_vis
-            gc.collect()
+        # Save area visualization (area_vis is RGB) as a preview, not at slide resolution
+        scale = min(1.0, AREA_PREVIEW_SIZE / max(area_vis.shape[:2]))
+        if scale < 1.0:
+            area_vis = cv2.resize(area_vis, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        area_panel = add_title_bar(
+            cv2.cvtColor(area_vis, cv2.COLOR_RGB2BGR),
+            f"ROI Area Measurement - Area: {area_sq_microns/1e6:.2f} mm^2",
+            bar_height=max(40, area_vis.shape[0] // 25)
+        )
+        area_path = vis_dir / f"{Path(metadata_row['Filename']).stem}_area_measurement.jpg"
+        if not cv2.imwrite(str(area_path), area_panel, VIS_JPEG_PARAMS):
+            logger.error(f"Could not write area visualization for {metadata_row['Filename']}")
+        del area_vis, area_panel
 
         # Create and save tiles
-        tile_paths = []
-        tiles = create_tiles_from_masked(masked_img, h_lines, v_lines)
+        saved_paths, previews = create_tiles_from_masked(
+            masked_img, gray, h_lines, v_lines, tiles_dir, Path(metadata_row['Filename']).stem
+        )
 
-        if not tiles:
+        if not saved_paths:
             logger.warning(f"No valid tiles found for {metadata_row['Filename']}")
             return None
 
-        # Save each tile
-        for tile_idx, tile in enumerate(tiles, 1):
-            try:
-                original_name = Path(metadata_row['Filename']).stem
-                new_name = f"{original_name} - {tile_idx}.png"
-                output_path = tiles_dir / new_name
-
-                cv2.imwrite(str(output_path), tile)
-                tile_paths.append(str(output_path.relative_to(base_path)))
-            finally:
-                del tile
-                gc.collect()
+        tile_paths = [str(path.relative_to(base_path)) for path in saved_paths]
 
-        # Create visualization
-        visualize_tile_process(masked_img, debug_img, tiles, metadata_row, vis_dir)
-        del debug_img, masked_img
-        gc.collect()
+        # Create visualization; its path is only recorded when it was written
+        vis_path = visualize_tile_process(masked_img, debug_img, previews, metadata_row, vis_dir)
+        if vis_path is not None:
+            vis_path = str(vis_path.relative_to(base_path))
 
-        return tile_paths, area_sq_microns
+        return tile_paths, area_sq_microns, vis_path
 
     except Exception as e:
         logger.error(f"Error processing {metadata_row['Filename']}: {str(e)}")
         return None
-    finally:
-        gc.collect()
+
+def init_worker():
+    """Limit each pool worker to one OpenCV thread so workers do not oversubscribe the CPUs."""
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(1)
+
+def process_image_job(job):
+    """Tile a single masked image in a worker process; returns the row index and result."""
+    idx, masked_path, grid_path, metadata_row, base_path, vis_dir, tiles_dir = job
+    return idx, process_single_image(masked_path, grid_path, metadata_row, base_path, vis_dir, tiles_dir)
+
+def existing_files(directory, listing_cache):
+    """Return the names of files in a directory, listing each directory only once."""
+    if directory not in listing_cache:
+        try:
+            with os.scandir(directory) as entries:
+                listing_cache[directory] = {entry.name for entry in entries if entry.is_file()}
+        except FileNotFoundError:
+            listing_cache[directory] = set()
+    return listing_cache[directory]
 
 def process_all_masked_images(drive_folder_path, stain_subset=None):
     """Process all masked images using metadata with improved memory management.
@@ -1087,19 +1117,6 @@ def process_all_masked_images(drive_folder_path, stain_subset=None):
     metadata_df = None
 
     try:
-        # Initial aggressive memory cleanup before starting
-        plt.close('all')
-        for _ in range(10):
-            gc.collect()
-
-        if platform.system() != 'Windows':
-            try:
-                os.system('sync')
-                os.system('echo 3 > /proc/sys/vm/drop_caches')
-            except Exception as e:
-                logger.warning(f"Could not perform initial memory cleanup: {e}")
-
-        time.sleep(5)  # Give system time to clean up
         log_memory()  # Log initial memory state
 
         base_path = Path(drive_folder_path)
@@ -1136,6 +1153,9 @@ def process_all_masked_images(drive_folder_path, stain_subset=None):
 
         logger.info(f"Processing staining types: {stain_types}")
 
+        # Metadata updates are collected for all stains and applied once at the end
+        updates = []
+
         # Process each staining type
         for stain in stain_types:
             try:
@@ -1152,83 +1172,49 @@ def process_all_masked_images(drive_folder_path, stain_subset=None):
                 stain_mask = metadata_df['Staining'] == stain
                 stain_indices = metadata_df.index[stain_mask].tolist()
 
-                # Clear mask to free memory
-                del stain_mask
-                gc.collect()
-
-                # Process all images in staining group
-                for idx in tqdm(stain_indices, desc=f"Processing {stain} images"):
-                    try:
-                        # Get row without copying entire dataframe
-                        row = metadata_df.loc[idx]
-
-                        # Check files exist
-                        masked_path = base_path / row['MaskedPath']
-                        grid_path = base_path / row['GridPath']
+                # Collect jobs for all images in staining group
+                jobs = []
+                listing_cache = {}
+                for idx in stain_indices:
+                    # Get row without copying entire dataframe
+                    row = metadata_df.loc[idx]
 
-                        if not (masked_path.exists() and grid_path.exists()):
-                            logger.warning(f"Missing files for {row['Filename']}")
-                            continue
-
-                        # Process single image
-                        result = process_single_image(
-                            masked_path,
-                            grid_path,
-                            row,
-                            base_path,
-                            stain_vis_dir,
-                            stain_tiles_dir
-                        )
-
-                        if result is not None:
-                            tile_paths, area_sq_microns = result
+                    if pd.isna(row['MaskedPath']) or pd.isna(row['GridPath']):
+                        logger.warning(f"Missing files for {row['Filename']}")
+                        continue
 
-                            # Update metadata
-                            metadata_df.at[idx, 'TilePaths'] = ';'.join(tile_paths)
-                            metadata_df.at[idx, 'ROIArea_sq_microns'] = area_sq_microns
+                    # Check files exist against one listing per directory instead of a stat per file
+                    masked_path = base_path / row['MaskedPath']
+                    grid_path = base_path / row['GridPath']
 
-                            # Save visualization path
-                            vis_filename = f"{Path(row['Filename']).stem}_grid_visualization.png"
-                            vis_path = stain_vis_dir / vis_filename
-                            metadata_df.at[idx, 'TILEVisualizationPath'] = str(vis_path.relative_to(base_path))
+                    if not (masked_path.name in existing_files(masked_path.parent, listing_cache)
+                            and grid_path.name in existing_files(grid_path.parent, listing_cache)):
+                        logger.warning(f"Missing files for {row['Filename']}")
+                        continue
 
-                            logger.info(f"Processed image with {len(tile_paths)} tiles, area: {area_sq_microns/1e6:.2f} mm²")
+                    jobs.append((idx, masked_path, grid_path, row.to_dict(), base_path, stain_vis_dir, stain_tiles_dir))
 
-                            # Clear temporary variables
-                            del tile_paths
-                            del area_sq_microns
-                            del vis_filename
-                            del vis_path
+                # Images are independent, so tile them in parallel and collect results as they arrive
+                with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count(), initializer=init_worker) as executor:
+                    futures = [executor.submit(process_image_job, job) for job in jobs]
 
-                    except Exception as e:
-                        logger.error(f"Error processing image {row['Filename']}: {e}")
-                        continue
-                    finally:
-                        # Clean up resources
-                        plt.close('all')
-                        gc.collect()
+                    for future in tqdm(as_completed(futures), total=len(futures), desc=f"Processing {stain} images"):
+                        try:
+                            idx, result = future.result()
 
-                # Save progress after staining group
-                metadata_df.to_csv(metadata_path, index=False)
-                log_memory()
+                            if result is not None:
+                                tile_paths, area_sq_microns, vis_path = result
 
-                # Aggressive cleanup after staining group
-                plt.close('all')
-                for _ in range(10):
-                    gc.collect()
+                                # Record metadata update with the visualization path, if one was written
+                                updates.append((idx, ';'.join(tile_paths), area_sq_microns, vis_path))
 
-                # Force memory release on Unix systems
-                if platform.system() != 'Windows':
-                    try:
-                        os.system('sync')
-                        os.system('echo 3 > /proc/sys/vm/drop_caches')
-                    except Exception as e:
-                        logger.warning(f"Could not sync memory: {e}")
+                                logger.info(f"Processed image with {len(tile_paths)} tiles, area: {area_sq_microns/1e6:.2f} mm²")
 
-                # Add waiting time to allow system to clear memory
-                time.sleep(5)
+                        except Exception as e:
+                            logger.error(f"Error processing image in {stain} staining: {e}")
+                            continue
 
-                # Log memory status after cleanup
+                # Log memory status
                 log_memory()
                 if platform.system() != 'Windows':
                     try:
@@ -1242,21 +1228,23 @@ def process_all_masked_images(drive_folder_path, stain_subset=None):
                 logger.error(f"Error processing staining type {stain}: {e}")
                 continue
             finally:
-                # Additional cleanup after each stain type
-                plt.close('all')
+                # Single collection per stain type; arrays are freed by refcount
                 gc.collect()
 
+        # Update metadata in one assignment per column and save once
+        if updates:
+            idxs, tile_paths, areas, vis_paths = zip(*updates)
+            metadata_df.loc[list(idxs), 'TilePaths'] = list(tile_paths)
+            metadata_df.loc[list(idxs), 'ROIArea_sq_microns'] = list(areas)
+            metadata_df.loc[list(idxs), 'TILEVisualizationPath'] = list(vis_paths)
+        metadata_df.to_csv(metadata_path, index=False)
+
         return metadata_path
 
     except Exception as e:
         logger.error(f"Error in process_all_masked_images: {str(e)}")
         return None
     finally:
-        # Final cleanup
-        plt.close('all')
-        if 'metadata_df' in locals():
-            del metadata_df
-        gc.collect()
         log_memory()
 
 def main():
@@ -1291,9 +1279,6 @@ def main():
 
     except Exception as e:
         logger.error(f"Error in main: {e}")
-    finally:
-        plt.close('all')
-        gc.collect()
 
 if __name__ == "__main__":
     main()
@@ -1311,12 +1296,28 @@ import cv2
 from tqdm import tqdm
 import os
 import re
+from functools import lru_cache
 from pathlib import Path
 from google.colab import drive
 import logging
 import gc
 import psutil
 
+# Numba builds the color lookup table when it is installed. Every Numba kernel in
+# this workflow is compiled serially (no parallel=True/prange): Numba's thread pool
+# is not fork-safe, and the process pools of Step 3 and the later steps fork from
+# this same Colab kernel
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Tile tables are written as Parquet when pyarrow is installed
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -1327,9 +1328,38 @@ def log_memory():
     memory_mb = process.memory_info().rss / 1024 / 1024
     logger.info(f"Memory usage: {memory_mb:.2f} MB")
 
+# Segment names repeat for every tile, so each one is only sanitized once
+@lru_cache(maxsize=None)
 def sanitize_filename(name):
     return re.sub(r'[^\w\-_]', '_', name)
 
+# Save the per-tile analysis figure for one tile in every ANALYSIS_VIS_INTERVAL per stain
+ANALYSIS_VIS_INTERVAL = 50
+
+# Checkpoint metadata.csv after every METADATA_CHECKPOINT_EVERY stains; it is always written once at the end
+METADATA_CHECKPOINT_EVERY = 3
+
+# Also write CSV copies of the tile tables (always done when pyarrow is missing)
+WRITE_TILE_CSV = os.getenv('WRITE_TILE_CSV', '0') == '1'
+
+# Build all_tile_data from the saved per-stain tables; set WRITE_COMBINED_TILE_DATA=0 to skip it
+WRITE_COMBINED_TILE_DATA = os.getenv('WRITE_COMBINED_TILE_DATA', '1') == '1'
+
+def save_tile_table(df, directory, name):
+    """Write a tile table as directory/name.parquet and/or .csv, returning the paths written."""
+    paths = []
+    if pyarrow is not None:
+        paths.append(directory / f'{name}.parquet')
+        df.to_parquet(paths[-1], index=False)
+    if pyarrow is None or WRITE_TILE_CSV:
+        paths.append(directory / f'{name}.csv')
+        df.to_csv(paths[-1], index=False)
+    return paths
+
+def load_tile_table(path):
+    """Read a tile table written by save_tile_table."""
+    return pd.read_parquet(path) if path.suffix == '.parquet' else pd.read_csv(path)
+
 def load_metadata(file_path):
     try:
         metadata_df = pd.read_csv(file_path)
@@ -1435,36 +1465,84 @@ def get_color_group(stain):
         print(f"Warning: No predefined color group for {stain}. Using IHC colors.")
         return predefined_groups['IHC']
 
-def segment_image(image, color_groups):
-    """Segment image based on color groups."""
-    try:
-        pixels = image.reshape(-1, 3).astype(np.float64)
-        distances = np.zeros((len(pixels), len(color_groups)))
-
-        for i, colors in enumerate(color_groups.values()):
-            colors_array = np.array(colors)
-            distances[:, i] = np.min(np.linalg.norm(pixels[:, np.newaxis] - colors_array, axis=2), axis=1)
-            del colors_array  # Free memory
-
-        white_pixels = np.all(pixels > 240, axis=1)
-        labels = np.zeros(len(pixels), dtype=int)
-        non_white_mask = ~white_pixels
-        labels[non_white_mask] = np.argmin(distances[non_white_mask], axis=1)
-        labels[white_pixels] = -1
+if njit is not None:
+    @njit
+    def fill_color_lut(all_colors, group_ids, lut):
+        """Fill the lookup table with one fused distance and argmin pass per RGB color."""
+        for r in range(256):
+            for g in range(256):
+                for b in range(256):
+                    label = -1
+                    if r <= 240 or g <= 240 or b <= 240:
+                        best = 1 << 30
+                        best_k = 0
+                        for k in range(all_colors.shape[0]):
+                            dr = r - all_colors[k, 0]
+                            dg = g - all_colors[k, 1]
+                            db = b - all_colors[k, 2]
+                            d = dr * dr + dg * dg + db * db
+                            if d < best:
+                                best = d
+                                best_k = k
+                        label = group_ids[best_k]
+                    lut[(r << 16) | (g << 8) | b] = label
+
+def build_color_lut(all_colors, group_ids):
+    """Build a 2^24-entry table mapping each RGB color to its nearest color group, or -1 for white."""
+    lut = np.empty(256 ** 3, dtype=np.int8)
+    if njit is not None:
+        fill_color_lut(all_colors, group_ids, lut)
+        return lut
+
+    # float32 keeps every product and sum below 2^24 exact while routing the
+    # cross term through BLAS sgemm, which integer np.dot does not use
+    colors = all_colors.astype(np.float32)
+    color_norms = (colors ** 2).sum(axis=1)[None, :]
+
+    # All (G, B) pairs for one R value; the table is filled one R plane at a time
+    g, b = np.divmod(np.arange(256 * 256, dtype=np.int32), 256)
+    plane = np.stack([np.zeros_like(g), g, b], axis=1).astype(np.float32)
+
+    for r in range(256):
+        plane[:, 0] = r
+        # Squared distance minus the per-pixel |p|^2 term, which does not change the argmin
+        d2 = np.dot(plane, colors.T)
+        d2 *= -2
+        d2 += color_norms
+        labels = group_ids[d2.argmin(axis=1)]
+        if r > 240:
+            labels[(g > 240) & (b > 240)] = -1
+        lut[r * 65536:(r + 1) * 65536] = labels
+
+    return lut
+
+def compile_color_groups(color_groups):
+    """Precompute the palette arrays and color lookup table for one stain's color groups."""
+    # Stack every palette color into one (K, 3) array with its group index
+    all_colors = np.concatenate([np.asarray(colors, dtype=np.int32) for colors in color_groups.values()])
+    group_ids = np.concatenate([np.full(len(colors), i, dtype=np.int8) for i, colors in enumerate(color_groups.values())])
+    return {
+        'all_colors': all_colors,
+        'group_ids': group_ids,
+        'group_names': list(color_groups.keys()),
+        'lut': build_color_lut(all_colors, group_ids)
+    }
 
-        del distances, pixels, white_pixels, non_white_mask  # Free memory
-        result = labels.reshape(image.shape[:2])
-        del labels  # Free memory
-        return result
+def segment_image(image, palette):
+    """Segment image based on a compiled color palette."""
+    try:
+        # Pack each RGB pixel into a 24-bit index and gather its group from the table
+        idx = (image[..., 0].astype(np.uint32) << 16) | (image[..., 1].astype(np.uint32) << 8) | image[..., 2]
+        return palette['lut'][idx]
 
     except Exception as e:
         print(f"Error in image segmentation: {e}")
         return None
 
-def create_visualization(image, segmented, white_mask, percentages, color_groups, stain, tile_path, show_percentages=False):
+def create_visualization(image, segmented, white_mask, percentages, group_names, stain, tile_path, show_percentages=False):
     """Create visualization of segmentation results."""
     try:
-        n_colors = len(color_groups)
+        n_colors = len(group_names)
         fig, axes = plt.subplots(1, n_colors + 1, figsize=(5 * (n_colors + 1), 5))
 
         # Original image
@@ -1472,19 +1550,17 @@ def create_visualization(image, segmented, white_mask, percentages, color_groups
         axes[0].set_title("Original Tile")
         axes[0].axis('off')
 
-        # Segmented regions
-        for i, (name, _) in enumerate(color_groups.items()):
-            segment = np.where(
-                np.logical_and(segmented[..., np.newaxis] == i,
-                             ~white_mask[..., np.newaxis]),
-                image,
-                [255, 255, 255]
-            )
-            axes[i + 1].imshow(segment.astype(np.uint8))
+        # Segmented regions; one uint8 canvas is reused, imshow keeps its own copy
+        canvas = np.full_like(image, 255)
+        non_white = ~white_mask
+        for i, name in enumerate(group_names):
+            mask = (segmented == i) & non_white
+            canvas[...] = 255
+            canvas[mask] = image[mask]
+            axes[i + 1].imshow(canvas)
             title = f"{name}\n({percentages[name]:.1f}%)"
             axes[i + 1].set_title(title)
             axes[i + 1].axis('off')
-            del segment  # Free memory
 
         plt.suptitle(f"Analysis of {os.path.basename(tile_path)}\n{stain} Staining", fontsize=10)
         plt.tight_layout()
@@ -1496,46 +1572,54 @@ def create_visualization(image, segmented, white_mask, percentages, color_groups
     finally:
         plt.close('all')
 
-def analyze_tile(tile_path, stain, color_groups, base_path, show_output=False):
-    """Analyze a single tile and return percentages."""
-    try:
-        full_tile_path = base_path / tile_path
-        if not full_tile_path.exists():
-            print(f"Tile not found: {full_tile_path}")
-            return None, None
+def read_tile(tile_path, base_path):
+    """Read a tile image as RGB, or return None if it is missing or unreadable."""
+    full_tile_path = base_path / tile_path
+    if not full_tile_path.exists():
+        print(f"Tile not found: {full_tile_path}")
+        return None
 
-        img = cv2.imread(str(full_tile_path))
-        if img is None:
-            print(f"Failed to read image: {full_tile_path}")
-            return None, None
+    img = cv2.imread(str(full_tile_path))
+    if img is None:
+        print(f"Failed to read image: {full_tile_path}")
+        return None
 
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        del img  # Free memory
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-        segmented = segment_image(img_rgb, color_groups)
-        if segmented is None:
-            return None, None
+def segment_tiles(images, palette):
+    """Segment all tiles of one image with a single segment_image call."""
+    sizes = [img.shape[0] * img.shape[1] for img in images]
+    pixels = np.concatenate([img.reshape(-1, 3) for img in images])
+
+    labels = segment_image(pixels, palette)
+    if labels is None:
+        return None
+
+    return [part.reshape(img.shape[:2]) for part, img in zip(np.split(labels, np.cumsum(sizes)[:-1]), images)]
 
-        white_mask = np.all(img_rgb > 240, axis=2)
-        total_valid_pixels = np.sum(~white_mask)
+def analyze_tile(tile_path, img_rgb, segmented, stain, palette, show_output=False):
+    """Analyze a single segmented tile and return percentages."""
+    try:
+        # Single SIMD pass over the 2-D image for pixels brighter than 240 in every channel
+        white_mask = cv2.inRange(img_rgb, (241, 241, 241), (255, 255, 255)) > 0
+
+        # Count every group's non-white pixels in a single pass
+        group_names = palette['group_names']
+        counts = np.bincount(segmented[~white_mask], minlength=len(group_names))
+        total_valid_pixels = counts.sum()
 
         if total_valid_pixels == 0:
             print(f"No valid pixels in tile: {tile_path}")
             return None, None
 
         # Calculate percentages
-        percentages = {}
-        for i, (name, _) in enumerate(color_groups.items()):
-            segment_pixels = np.sum(np.logical_and(segmented == i, ~white_mask))
-            percentage = (segment_pixels / total_valid_pixels) * 100
-            percentages[name] = percentage
-
-        # Create visualization
-        fig = create_visualization(img_rgb, segmented, white_mask, percentages,
-                                 color_groups, stain, tile_path, show_percentages=show_output)
+        percentages = {name: (counts[i] / total_valid_pixels) * 100 for i, name in enumerate(group_names)}
 
-        del img_rgb, segmented, white_mask  # Free memory
-        gc.collect()  # Force garbage collection
+        # Create visualization only when requested
+        fig = None
+        if show_output:
+            fig = create_visualization(img_rgb, segmented, white_mask, percentages,
+                                     palette['group_names'], stain, tile_path, show_percentages=show_output)
 
         return fig, percentages
 
@@ -1579,12 +1663,16 @@ def process_tiles_for_staining(metadata_df, stain, color_groups, base_path):
     print(f"Displaying color palette for {stain} staining...")
     display_color_palette(color_groups, stain, f"Color Palette for {stain} Stain")
 
+    # Compile the palette once and share it across every tile of this stain
+    palette = compile_color_groups(color_groups)
+
     # Get relevant rows and create a copy to avoid modifying original
     stain_rows = metadata_df[metadata_df['Staining'] == stain].copy()
     print(f"Found {len(stain_rows)} images with {stain} staining")
 
     # Initialize percentage and SD columns, and create a list to store tile data
     tile_data_list = []
+    tiles_seen = 0
 
     for segment_name in color_groups.keys():
         mean_col = f"{stain}_{sanitize_filename(segment_name)}_Percentage"
@@ -1606,8 +1694,20 @@ def process_tiles_for_staining(metadata_df, stain, color_groups, base_path):
             tile_paths = row['TilePaths'].split(';')
             segment_percentages = {name: [] for name in color_groups.keys()}
 
-            for tile_path in tile_paths:
-                fig, percentages = analyze_tile(tile_path, stain, color_groups, base_path, show_output=False)
+            # Read every tile of the image and segment them together in one batch
+            loaded = [(tile_path, read_tile(tile_path, base_path)) for tile_path in tile_paths]
+            loaded = [(tile_path, img) for tile_path, img in loaded if img is not None]
+            if not loaded:
+                continue
+            segmented_tiles = segment_tiles([img for _, img in loaded], palette)
+            if segmented_tiles is None:
+                continue
+
+            for (tile_path, img_rgb), segmented in zip(loaded, segmented_tiles):
+                # Figures are expensive; only a sample of tiles gets one
+                show_output = tiles_seen % ANALYSIS_VIS_INTERVAL == 0
+                tiles_seen += 1
+                fig, percentages = analyze_tile(tile_path, img_rgb, segmented, stain, palette, show_output=show_output)
 
                 if percentages:
                     # Store individual tile data
@@ -1661,16 +1761,16 @@ def process_tiles_for_staining(metadata_df, stain, color_groups, base_path):
 
     # Save individual tile data
     tile_df = pd.DataFrame(tile_data_list)
-    tile_data_path = base_path / f'{stain}_tile_data.csv'
-    tile_df.to_csv(tile_data_path, index=False)
-    print(f"Saved individual tile data to: {tile_data_path}")
+    tile_data_paths = save_tile_table(tile_df, base_path, f'{stain}_tile_data')
+    for tile_data_path in tile_data_paths:
+        print(f"Saved individual tile data to: {tile_data_path}")
 
     # Final cleanup
     plt.close('all')
     gc.collect()
     log_memory()
 
-    return metadata_df, tile_df
+    return metadata_df, tile_df, tile_data_paths[0]
 
 def main():
     # Mount Google Drive if not already mounted
@@ -1708,23 +1808,34 @@ def main():
     stain_types = metadata_df['Staining'].unique()
     logger.info(f"Detected stain types: {stain_types}")
 
-    # Create a dictionary to store all tile DataFrames
-    all_tile_data = {}
+    # Only the saved path and a summary of each stain's tile table are kept, so
+    # one stain's tiles are in memory at a time
+    tile_data_paths = []
+    tile_summaries = {}
 
     try:
         # Process each stain type
-        for stain in stain_types:
+        for stain_idx, stain in enumerate(stain_types):
             logger.info(f"\nProcessing {stain} staining...")
             color_group = get_color_group(stain)
 
             # Process tiles and get both metadata and tile data
-            metadata_df, tile_df = process_tiles_for_staining(metadata_df, stain, color_group, base_path)
-
-            # Store tile data
-            all_tile_data[stain] = tile_df
+            metadata_df, tile_df, tile_data_path = process_tiles_for_staining(metadata_df, stain, color_group, base_path)
+
+            # Keep the saved table's path and summary, then free the tile data
+            if len(tile_df) > 0:
+                tile_data_paths.append(tile_data_path)
+            tile_summaries[stain] = {
+                'tiles': len(tile_df),
+                'animals': tile_df['Animal'].nunique() if 'Animal' in tile_df else 0,
+                'conditions': tile_df['Condition'].nunique() if 'Condition' in tile_df else 0,
+                'percentage_columns': [col for col in tile_df.columns if 'Percentage' in col]
+            }
+            del tile_df
 
-            # Save progress after each stain type
-            metadata_df.to_csv(metadata_path, index=False)
+            # Checkpoint progress every few stain types
+            if (stain_idx + 1) % METADATA_CHECKPOINT_EVERY == 0 and stain_idx + 1 < len(stain_types):
+                metadata_df.to_csv(metadata_path, index=False)
 
             # Verify columns were created
             stain_cols = [col for col in metadata_df.columns
@@ -1740,19 +1851,25 @@ def main():
         metadata_df.to_csv(metadata_path, index=False)
         logger.info("\nMetadata saved successfully")
 
-        # Save combined tile data
-        combined_tile_data = pd.concat(all_tile_data.values(), ignore_index=True)
-        combined_tile_path = base_path / 'all_tile_data.csv'
-        combined_tile_data.to_csv(combined_tile_path, index=False)
-        logger.info(f"\nSaved combined tile data to: {combined_tile_path}")
+        # Save combined tile data, read back from the per-stain tables; stains have different
+        # percentage columns, so align every frame to the union of columns and concatenate once
+        if WRITE_COMBINED_TILE_DATA and tile_data_paths:
+            tile_frames = [load_tile_table(path) for path in tile_data_paths]
+            all_columns = list(dict.fromkeys(col for tile_df in tile_frames for col in tile_df.columns))
+            combined_tile_data = pd.concat([tile_df.reindex(columns=all_columns) for tile_df in tile_frames],
+                                           ignore_index=True)
+            del tile_frames
+            for combined_tile_path in save_tile_table(combined_tile_data, base_path, 'all_tile_data'):
+                logger.info(f"\nSaved combined tile data to: {combined_tile_path}")
+            del combined_tile_data
 
         # Print summary of tile data
-        for stain, tile_df in all_tile_data.items():
+        for stain, summary in tile_summaries.items():
             logger.info(f"\n{stain} tile data summary:")
-            logger.info(f"Number of tiles: {len(tile_df)}")
-            logger.info(f"Number of animals: {tile_df['Animal'].nunique()}")
-            logger.info(f"Number of conditions: {tile_df['Condition'].nunique()}")
-            logger.info(f"Percentage columns: {[col for col in tile_df.columns if 'Percentage' in col]}")
+            logger.info(f"Number of tiles: {summary['tiles']}")
+            logger.info(f"Number of animals: {summary['animals']}")
+            logger.info(f"Number of conditions: {summary['conditions']}")
+            logger.info(f"Percentage columns: {summary['percentage_columns']}")
 
         # Verify percentage columns in metadata
         percentage_cols = [col for col in metadata_df.columns
@@ -1777,32 +1894,192 @@ if __name__ == "__main__":
 
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+import math
+from matplotlib.collections import PatchCollection
 from scipy import stats
-import statsmodels.api as sm
 import statsmodels.formula.api as smf
-from statsmodels.stats.multitest import multipletests
 import os
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 from google.colab import drive
 import warnings
 warnings.filterwarnings('ignore')
 import logging
 
+# Numba compiles the box plot statistics and pairwise Welch tests when it is installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Only needed to read the column names of Parquet tile tables
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Figures that are also saved as SVG keep full quality there, so their PNG copy is a preview
+PNG_DPI = int(os.getenv('PLOT_DPI', '150'))
+
+# Fit one Condition x Week mixed model per segment and test weeks by contrasts;
+# set POOLED_MIXED_MODEL=0 to refit a separate model for every week instead
+POOLED_MIXED_MODEL = os.getenv('POOLED_MIXED_MODEL', '1') == '1'
+
+# Seed for the horizontal jitter of individual points in the box plots
+JITTER_SEED = 42
+
+# Columns that every plot and test filters or groups on
+CATEGORICAL_COLUMNS = ['Staining', 'Condition', 'Location', 'Animal']
+
+# Parse dtypes of the tile CSVs, so the grouping columns are built as categoricals directly
+TILE_TABLE_DTYPES = {**{col: 'category' for col in CATEGORICAL_COLUMNS}, 'Week': 'int16'}
+
+# Tile table columns the plots and tests use besides the stain's percentage columns
+TILE_KEY_COLUMNS = ['Week', 'Condition', 'Animal', 'Location']
+
+# Shared matplotlib style of the analysis and area plots
+PLOT_STYLE = {
+    'figure.figsize': (15, 10),
+    'axes.grid': True,
+    'grid.alpha': 0.3,
+    'grid.linestyle': '--'
+}
+
+@lru_cache(maxsize=None)
 def sanitize_filename(name):
     """Convert a string to a valid filename by replacing invalid characters."""
     return name.replace('/', '_').replace('\\', '_').replace(' ', '_')
 
+def categorize_columns(df):
+    """Store the grouping columns as categoricals and Week as the smallest integer type that fits."""
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    if 'Week' in df.columns:
+        df['Week'] = pd.to_numeric(df['Week'], downcast='integer')
+    return df
+
+if njit is not None:
+    # error_model='numpy' gives inf/nan on division by zero, as the NumPy path does;
+    # serial like every kernel here, see the Numba note in Step 3
+    @njit(error_model='numpy')
+    def welch_statistics(n, mean, var, pair_i, pair_j):
+        """Welch t statistic and Satterthwaite degrees of freedom for every group pair."""
+        t_stat = np.empty(pair_i.shape[0])
+        df = np.empty(pair_i.shape[0])
+        for k in range(pair_i.shape[0]):
+            i = pair_i[k]
+            j = pair_j[k]
+            vn1 = var[i] / n[i]
+            vn2 = var[j] / n[j]
+            df[k] = (vn1 + vn2)**2 / (vn1**2 / (n[i] - 1) + vn2**2 / (n[j] - 1))
+            # Zero variance in both groups leaves df undefined; any finite value gives the same p-value
+            if np.isnan(df[k]):
+                df[k] = 1.0
+            t_stat[k] = (mean[i] - mean[j]) / np.sqrt(vn1 + vn2)
+        return t_stat, df
+else:
+    def welch_statistics(n, mean, var, pair_i, pair_j):
+        """Welch t statistic and Satterthwaite degrees of freedom for every group pair."""
+        vn1 = var[pair_i] / n[pair_i]
+        vn2 = var[pair_j] / n[pair_j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df = (vn1 + vn2)**2 / (vn1**2 / (n[pair_i] - 1) + vn2**2 / (n[pair_j] - 1))
+            # Zero variance in both groups leaves df undefined; any finite value gives the same p-value
+            df = np.where(np.isnan(df), 1.0, df)
+            t_stat = (mean[pair_i] - mean[pair_j]) / np.sqrt(vn1 + vn2)
+        return t_stat, df
+
+def group_summaries(group_values):
+    """Sizes, means and sample variances (NaN for single values) of a list of value arrays."""
+    n = np.array([len(values) for values in group_values], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.array([values.mean() for values in group_values])
+        variances = np.array([values.var(ddof=1) if len(values) > 1 else np.nan
+                              for values in group_values])
+    return n, means, variances
+
+def welch_ttest(n, mean, var, pair_i, pair_j):
+    """Welch's t-test between groups pair_i and pair_j from per-group sizes, means and variances.
+
+    Matches stats.ttest_ind(equal_var=False) on the underlying values.
+    """
+    t_stat, df = welch_statistics(n, mean, var, pair_i, pair_j)
+    p_values = 2 * stats.t.sf(np.abs(t_stat), df)
+    return t_stat, p_values
+
+def read_tile_table(folder, staining, columns=None):
+    """Load a stain's tile table, preferring the Parquet copy written by the segmentation step."""
+    parquet_path = folder / f'{staining}_tile_data.parquet'
+    if parquet_path.exists():
+        return pd.read_parquet(parquet_path, columns=columns)
+    return pd.read_csv(folder / f'{staining}_tile_data.csv', usecols=columns,
+                       dtype=TILE_TABLE_DTYPES, engine='c')
+
+def read_tile_columns(folder, staining):
+    """Column names of a stain's tile table, read without loading its rows."""
+    parquet_path = folder / f'{staining}_tile_data.parquet'
+    csv_path = folder / f'{staining}_tile_data.csv'
+    if parquet_path.exists():
+        if pq is not None:
+            return pq.read_schema(parquet_path).names
+        # Without pyarrow the CSV copy's header is used, else pandas' own Parquet engine
+        if not csv_path.exists():
+            return list(pd.read_parquet(parquet_path).columns)
+    return list(pd.read_csv(csv_path, nrows=0).columns)
+
+def fit_pooled_mixed_model(data, percentage_col):
+    """Fit one mixed model with a fixed mean per observed (Condition, Week) cell and a random intercept per animal."""
+    model_data = data[['Week', 'Condition', 'Animal', percentage_col]].copy()
+    model_data[percentage_col] = pd.to_numeric(model_data[percentage_col], errors='coerce')
+    model_data = model_data.dropna(subset=[percentage_col])
+
+    # Cell means coding of Condition*Week; only observed cells get a column, so
+    # conditions missing from some weeks do not make the design singular
+    model_data['Cell'] = model_data['Condition'].astype(str) + '_W' + model_data['Week'].astype(str)
+    # Animal numbers restart in every condition and week, so the same number in
+    # another cell is a different rat and gets its own random intercept
+    model_data['Subject'] = model_data['Cell'] + '_A' + model_data['Animal'].astype(str)
+
+    try:
+        model = smf.mixedlm(f"{percentage_col} ~ 0 + C(Cell)", data=model_data, groups=model_data["Subject"])
+        return model.fit()
+    except Exception as e:
+        print(f"Error fitting pooled mixed effects model: {str(e)}")
+        return None
+
+def pooled_week_contrasts(model_results, week, conditions):
+    """Test every pair of conditions within one week against the pooled model's cell means; None if fewer than two are in the model."""
+    # Only cells the model was fitted on have a column; conditions without one are left out
+    cells = {condition: f"C(Cell)[{condition}_W{week}]" for condition in conditions}
+    conditions = [condition for condition in conditions if cells[condition] in model_results.fe_params.index]
+    if len(conditions) < 2:
+        return None
+    columns = np.array([model_results.fe_params.index.get_loc(cells[condition]) for condition in conditions])
+    pair_i, pair_j = np.triu_indices(len(conditions), k=1)
+    rows = np.arange(len(pair_i))
+    L = np.zeros((len(pair_i), len(model_results.fe_params)))
+    L[rows, columns[pair_i]] = 1
+    L[rows, columns[pair_j]] = -1
+    contrasts = model_results.t_test(L)
+    return contrasts.summary(xname=[f"{conditions[a]} - {conditions[b]}" for a, b in zip(pair_i, pair_j)])
+
 def perform_statistical_analysis(data, staining, location, segment_name,
                                percentage_col, output_dir, safe_location, safe_segment):
     """Perform mixed effects statistical analysis for each week separately."""
     weeks = sorted(data['Week'].unique())
     results = []
+    filename_base = f'{staining}_{safe_location}_{safe_segment}'
 
     FONT_SIZE = {
         'title': 18,
@@ -1815,16 +2092,13 @@ def perform_statistical_analysis(data, staining, location, segment_name,
     print(f"Number of weeks to analyze: {len(weeks)}")
 
     # Create comprehensive p-value matrix across all timepoints
-    # First, get only the groups that actually have data
+    # Group the values once; groupby only yields groups that actually have data,
+    # ordered by week and then condition
     all_groups = []
-    for week in weeks:
-        week_data = data[data['Week'] == week]
-        conditions = sorted(week_data['Condition'].unique())
-        for condition in conditions:
-            if len(week_data[week_data['Condition'] == condition]) > 0:  # Check if there's actual data
-                all_groups.append(f"{condition}_W{week}")
-
-    comprehensive_matrix = pd.DataFrame(1.0, index=all_groups, columns=all_groups)
+    group_values = []
+    for (week, condition), values in data.groupby(['Week', 'Condition'], observed=True)[percentage_col]:
+        all_groups.append(f"{condition}_W{week}")
+        group_values.append(values.to_numpy(dtype=float))
 
     # Add comprehensive analysis results to text output
     results.extend([
@@ -1837,24 +2111,18 @@ def perform_statistical_analysis(data, staining, location, segment_name,
         "\nPairwise Comparisons:"
     ])
 
-    # Perform all pairwise comparisons
-    from itertools import combinations
-    pairs = list(combinations(all_groups, 2))
-
-    for group1, group2 in pairs:
-        cond1, week1 = group1.rsplit('_W', 1)
-        cond2, week2 = group2.rsplit('_W', 1)
+    # Perform all pairwise comparisons at once from per-group summary statistics
+    n, means, variances = group_summaries(group_values)
+    i, j = np.triu_indices(len(all_groups), k=1)
+    _, p_values = welch_ttest(n, means, variances, i, j)
 
-        values1 = data[(data['Week'] == int(week1)) &
-                     (data['Condition'] == cond1)][percentage_col]
-        values2 = data[(data['Week'] == int(week2)) &
-                     (data['Condition'] == cond2)][percentage_col]
+    p_matrix = np.ones((len(all_groups), len(all_groups)))
+    p_matrix[i, j] = p_values
+    p_matrix[j, i] = p_values
+    comprehensive_matrix = pd.DataFrame(p_matrix, index=all_groups, columns=all_groups)
 
-        if len(values1) > 0 and len(values2) > 0:  # Only compare if both groups have data
-            t_stat, p_value = stats.ttest_ind(values1, values2, equal_var=False)
-            comprehensive_matrix.loc[group1, group2] = p_value
-            comprehensive_matrix.loc[group2, group1] = p_value
-            results.append(f"{group1} vs {group2}: p-value = {p_value:.6f}")
+    results.extend(f"{all_groups[a]} vs {all_groups[b]}: p-value = {p_value:.6f}"
+                   for a, b, p_value in zip(i, j, p_values))
 
     results.extend([
         "\nComprehensive P-value Matrix:",
@@ -1864,7 +2132,7 @@ def perform_statistical_analysis(data, staining, location, segment_name,
     ])
 
     # Create comprehensive heatmap
-    plt.figure(figsize=(15, 13))
+    fig = plt.figure(figsize=(15, 13))
     mask = np.triu(np.ones_like(comprehensive_matrix, dtype=bool), k=1)
 
     sns.heatmap(comprehensive_matrix.astype(float),
@@ -1885,12 +2153,24 @@ def perform_statistical_analysis(data, staining, location, segment_name,
     plt.tight_layout()
 
     # Save comprehensive heatmap
-    filename_base = f'{staining}_{safe_location}_{safe_segment}'
     comp_heatmap_path = output_dir / f'{filename_base}_comprehensive_pvalues.png'
-    plt.savefig(str(comp_heatmap_path), dpi=300, bbox_inches='tight')
-    plt.savefig(str(output_dir / f'{filename_base}_comprehensive_pvalues.svg'),
+    fig.savefig(str(comp_heatmap_path), dpi=PNG_DPI, bbox_inches='tight')
+    fig.savefig(str(output_dir / f'{filename_base}_comprehensive_pvalues.svg'),
                 format='svg', bbox_inches='tight')
-    plt.close()
+    plt.close(fig)
+
+    # Pooled model for the week-by-week contrasts
+    pooled_results = fit_pooled_mixed_model(data, percentage_col) if POOLED_MIXED_MODEL else None
+    if pooled_results is not None:
+        print("\nPooled Model Summary:")
+        print(pooled_results.summary())
+        results.extend([
+            "\nPooled Mixed Effects Model (Condition x Week):",
+            str(pooled_results.summary())
+        ])
+
+    # Non-missing samples per (week, condition), to skip weeks nothing can be tested in
+    sample_counts = data.groupby(['Week', 'Condition'], observed=True)[percentage_col].count()
 
     # Original week-by-week analysis
     for week in weeks:
@@ -1915,47 +2195,57 @@ def perform_statistical_analysis(data, staining, location, segment_name,
             print(f"Only one or no conditions available for week {week}, skipping statistical analysis")
             continue
 
+        # The mixed model and the t-tests need two conditions with at least two samples each
+        if (sample_counts.loc[week] >= 2).sum() < 2:
+            print(f"Fewer than two conditions with two or more samples for week {week}, skipping statistical analysis")
+            continue
+
         try:
-            # Ensure correct data types
-            week_data['Animal'] = week_data['Animal'].astype(str)
-            week_data['Condition'] = week_data['Condition'].astype('category')
+            if pooled_results is not None:
+                # Condition differences within this week from the pooled model, no refit
+                model_label = "Pooled Mixed Effects Model Contrasts:"
+                model_summary = pooled_week_contrasts(pooled_results, week, sorted(available_conditions))
+                if model_summary is None:
+                    model_summary = "Fewer than two conditions of this week in the pooled model, no contrasts"
+            else:
+                # Drop condition categories that only occur in other weeks
+                week_data['Condition'] = week_data['Condition'].astype('category').cat.remove_unused_categories()
 
-            # Fit mixed effects model
-            model = smf.mixedlm(f"{percentage_col} ~ Condition", data=week_data, groups=week_data["Animal"])
-            model_results = model.fit()
+                # Fit mixed effects model
+                model = smf.mixedlm(f"{percentage_col} ~ Condition", data=week_data, groups=week_data["Animal"])
+                model_label = "Mixed Effects Model Results:"
+                model_summary = model.fit().summary()
 
             print("\nModel Summary:")
-            print(model_results.summary())
+            print(model_summary)
 
-            # Perform pairwise comparisons only for available conditions
-            from itertools import combinations
-            pairs = list(combinations(available_conditions, 2))
-            p_values = []
+            # Perform pairwise comparisons only for available conditions; every
+            # available condition has data, so each pair is compared
+            condition_values = {condition: values.to_numpy(dtype=float) for condition, values
+                                in week_data.groupby('Condition', observed=True)[percentage_col]}
+            n, means, variances = group_summaries([condition_values[condition]
+                                                   for condition in available_conditions])
+            pair_i, pair_j = np.triu_indices(len(available_conditions), k=1)
+            _, p_values = welch_ttest(n, means, variances, pair_i, pair_j)
 
             print("\nPairwise Comparisons:")
-            for pair in pairs:
-                group1 = week_data[week_data['Condition'] == pair[0]][percentage_col]
-                group2 = week_data[week_data['Condition'] == pair[1]][percentage_col]
-
-                if len(group1) > 0 and len(group2) > 0:  # Only compare if both groups have data
-                    t_stat, p_value = stats.ttest_ind(group1, group2, equal_var=False)
-                    p_values.append(p_value)
-                    print(f"{pair[0]} vs {pair[1]}: p-value = {p_value:.6f}")
+            for a, b, p_value in zip(pair_i, pair_j, p_values):
+                print(f"{available_conditions[a]} vs {available_conditions[b]}: p-value = {p_value:.6f}")
 
-            if p_values:  # Only create heatmap if we have comparisons
-                # Adjust p-values for multiple comparisons
-                reject, pvals_corrected, _, _ = multipletests(p_values, method='bonferroni')
-                p_value_matrix = pd.DataFrame(1.0, index=available_conditions, columns=available_conditions)
-
-                for idx, pair in enumerate(pairs):
-                    p_value = pvals_corrected[idx]
-                    p_value_matrix.loc[pair[0], pair[1]] = p_value
-                    p_value_matrix.loc[pair[1], pair[0]] = p_value
+            if len(p_values) > 0:  # Only create heatmap if we have comparisons
+                # Adjust p-values for multiple comparisons (Bonferroni)
+                pvals_corrected = np.minimum(p_values * len(p_values), 1.0)
+                p_matrix = np.ones((len(available_conditions), len(available_conditions)))
+                p_matrix[pair_i, pair_j] = pvals_corrected
+                p_matrix[pair_j, pair_i] = pvals_corrected
+                condition_labels = list(available_conditions)
 
                 # Generate heatmap
-                plt.figure(figsize=(8, 6))
-                sns.heatmap(p_value_matrix.astype(float),
-                           mask=np.triu(np.ones_like(p_value_matrix, dtype=bool), k=1),
+                fig = plt.figure(figsize=(8, 6))
+                sns.heatmap(p_matrix,
+                           xticklabels=condition_labels,
+                           yticklabels=condition_labels,
+                           mask=np.triu(np.ones_like(p_matrix, dtype=bool), k=1),
                            annot=True, cmap='coolwarm_r',
                            vmin=0, vmax=1,
                            fmt='.6f',
@@ -1970,18 +2260,17 @@ def perform_statistical_analysis(data, staining, location, segment_name,
                 plt.tight_layout()
 
                 # Save heatmap
-                filename_base = f'{staining}_{safe_location}_{safe_segment}'
                 heatmap_path = output_dir / f'{filename_base}_week{week}_pvalues.png'
-                plt.savefig(str(heatmap_path), dpi=250, bbox_inches='tight')
-                plt.close()
+                fig.savefig(str(heatmap_path), dpi=250, bbox_inches='tight')
+                plt.close(fig)
 
                 # Save results
                 results.extend([
                     f"\nWeek {week}:",
-                    "Mixed Effects Model Results:",
-                    str(model_results.summary()),
+                    model_label,
+                    str(model_summary),
                     "\nPairwise t-tests with Bonferroni correction:",
-                    str(p_value_matrix)
+                    str(pd.DataFrame(p_matrix, index=condition_labels, columns=condition_labels))
                 ])
 
         except Exception as e:
@@ -1990,18 +2279,305 @@ def perform_statistical_analysis(data, staining, location, segment_name,
 
     # Save statistical results
     if results:
-        filename_base = f'{staining}_{safe_location}_{safe_segment}'
         results_path = output_dir / f'{filename_base}_stats.txt'
         with open(results_path, 'w') as f:
             f.write(f"Statistical Analysis for {staining} - {location} - {segment_name}\n")
             f.write("\n".join(results))
 
 
+def derive_condition_colors(condition_colors):
+    """Map each condition to its (box_color, marker_color): the base color lightened and darkened."""
+    derived = {}
+    for condition, base_color in condition_colors.items():
+        r, g, b, a = plt.matplotlib.colors.to_rgba(base_color)
+        box_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
+        marker_color = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
+        derived[condition] = (box_color, marker_color)
+    return derived
+
+if njit is not None:
+    @njit
+    def box_stats_kernel(values, starts, counts):
+        """Quartiles, whiskers and nan-aware mean for each group slice of a concatenated array."""
+        quantiles = np.array([0.25, 0.5, 0.75])
+        out = np.empty((starts.shape[0], 6))
+        for k in range(starts.shape[0]):
+            # np.sort places NaNs last
+            x = np.sort(values[starts[k]:starts[k] + counts[k]])
+            n = x.shape[0]
+            n_valid = 0
+            total = 0.0
+            for v in x:
+                if not np.isnan(v):
+                    n_valid += 1
+                    total += v
+
+            for col in range(3):
+                if n_valid < n:
+                    # np.percentile propagates NaN
+                    out[k, col] = np.nan
+                else:
+                    position = quantiles[col] * (n - 1)
+                    lower = int(math.floor(position))
+                    upper = int(math.ceil(position))
+                    out[k, col] = x[lower] + (x[upper] - x[lower]) * (position - lower)
+
+            data_min = x[0] if n_valid > 0 else np.nan
+            data_max = x[n_valid - 1] if n_valid > 0 else np.nan
+            iqr = out[k, 2] - out[k, 0]
+            low = out[k, 0] - 1.5 * iqr
+            high = out[k, 2] + 1.5 * iqr
+            out[k, 3] = data_min if np.isnan(low) else (low if np.isnan(data_min) else max(data_min, low))
+            out[k, 4] = data_max if np.isnan(high) else (high if np.isnan(data_max) else min(data_max, high))
+            out[k, 5] = total / n_valid if n_valid > 0 else np.nan
+        return out
+
+def group_box_stats(grouped):
+    """Quartiles, whiskers and mean for every group of a {key: values} dict in one vectorized pass.
+
+    Returns {key: (q1, median, q3, whisker_low, whisker_high, mean)} using the same linear
+    interpolation as np.percentile; whiskers extend 1.5 IQR, clipped to the data range.
+    """
+    keys = list(grouped)
+    if not keys:
+        return {}
+    counts = np.array([len(grouped[key]) for key in keys])
+    values = np.concatenate([np.asarray(grouped[key], dtype=float) for key in keys])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    if njit is not None:
+        return {key: tuple(box) for key, box in zip(keys, box_stats_kernel(values, starts, counts))}
+
+    # Sort values within each group (NaNs last) so quantiles become index lookups
+    group_ids = np.repeat(np.arange(len(keys)), counts)
+    sorted_values = values[np.lexsort((values, group_ids))]
+    is_nan = np.isnan(sorted_values)
+    n_valid = counts - np.add.reduceat(is_nan, starts)
+    has_nan = n_valid < counts
+
+    quartiles = []
+    for q in (0.25, 0.5, 0.75):
+        position = starts + q * (counts - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        value = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+        # np.percentile propagates NaN
+        quartiles.append(np.where(has_nan, np.nan, value))
+    q1, median, q3 = quartiles
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data_min = np.where(n_valid > 0, sorted_values[starts], np.nan)
+        data_max = np.where(n_valid > 0, sorted_values[starts + np.maximum(n_valid - 1, 0)], np.nan)
+        mean = np.add.reduceat(np.where(is_nan, 0.0, sorted_values), starts) / n_valid
+
+    iqr = q3 - q1
+    whisker_low = np.fmax(data_min, q1 - 1.5 * iqr)
+    whisker_high = np.fmin(data_max, q3 + 1.5 * iqr)
+
+    return {key: box for key, box in zip(keys, zip(q1, median, q3, whisker_low, whisker_high, mean))}
+
+def draw_condition_boxes(ax, boxes, derived_colors, marker_styles, point_size):
+    """Draw jittered points, box, median, whiskers and mean marker for every box with batched artists.
+
+    Each entry of boxes is (condition, pos, values, box_stats) with box_stats as returned by
+    group_box_stats. Point jitter comes from one seeded generator, so figures are reproducible.
+    """
+    if not boxes:
+        return
+
+    conditions = [box[0] for box in boxes]
+    positions = np.array([box[1] for box in boxes])
+    q1, median, q3, whisker_low, whisker_high, mean = np.array([box[3] for box in boxes]).T
+    box_colors = [derived_colors[condition][0] for condition in conditions]
+    marker_colors = [derived_colors[condition][1] for condition in conditions]
+
+    # Boxes and whiskers
+    rectangles = [plt.Rectangle((pos - 0.1, low), 0.2, high - low)
+                  for pos, low, high in zip(positions, q1, q3)]
+    ax.add_collection(PatchCollection(rectangles,
+                                      facecolors=box_colors,
+                                      edgecolors='black',
+                                      linewidths=1,
+                                      zorder=2))
+    ax.vlines(positions, whisker_low, whisker_high,
+              colors=box_colors,
+              linewidth=2.0,
+              zorder=2)
+    ax.hlines(np.concatenate([whisker_low, whisker_high]),
+              np.tile(positions - 0.1, 2), np.tile(positions + 0.1, 2),
+              colors=box_colors * 2,
+              linewidth=2.0,
+              zorder=2)
+
+    # Individual points with circles
+    point_counts = [len(box[2]) for box in boxes]
+    jitter = np.random.default_rng(JITTER_SEED).normal(0, 0.02, size=sum(point_counts))
+    ax.scatter(np.repeat(positions, point_counts) + jitter,
+               np.concatenate([box[2] for box in boxes]),
+               marker='o',
+               c=np.repeat(np.array(marker_colors), point_counts, axis=0),
+               edgecolor='black',
+               linewidth=1,
+               alpha=0.8,
+               s=point_size,
+               zorder=3)
+
+    ax.hlines(median, positions - 0.1, positions + 0.1,
+              colors='black',
+              linewidth=2.0,
+              zorder=3)
+
+    # Means with condition-specific markers, one artist per condition
+    for condition in dict.fromkeys(conditions):
+        selected = [i for i, box_condition in enumerate(conditions) if box_condition == condition]
+        box_color, marker_color = derived_colors[condition]
+        ax.plot(positions[selected], mean[selected],
+                linestyle='none',
+                marker=marker_styles[condition],
+                color=box_color,
+                markerfacecolor=marker_color,
+                markeredgecolor='black',
+                markeredgewidth=1,
+                markersize=12,
+                alpha=0.9,
+                zorder=4)
+
+# Per-process state of the plotting workers, filled by init_plot_worker
+worker_state = {}
+
+def init_plot_worker(tile_data_folder, plot_settings):
+    """Load the stain's tile table once per worker."""
+    plt.rcParams.update(PLOT_STYLE)
+    worker_state['tile_data'] = categorize_columns(read_tile_table(tile_data_folder, plot_settings['staining'],
+                                                                   columns=plot_settings['columns']))
+    worker_state['settings'] = plot_settings
+    worker_state['location_data'] = {}
+
+def plot_segment(task):
+    """Draw the analysis plot of one location and segment, then run its statistics."""
+    location, percentage_col, segment_name, safe_segment = task
+    settings = worker_state['settings']
+    staining = settings['staining']
+    all_weeks = settings['all_weeks']
+    all_conditions = settings['all_conditions']
+    derived_colors = settings['derived_colors']
+    marker_styles = settings['marker_styles']
+    output_dir = settings['output_dir']
+
+    if location not in worker_state['location_data']:
+        tile_data = worker_state['tile_data']
+        worker_state['location_data'][location] = tile_data[tile_data['Location'] == location]
+    location_data = worker_state['location_data'][location]
+    safe_location = sanitize_filename(location)
+    filename_base = f'{staining}_{safe_location}_{safe_segment}'
+
+    fig, ax = plt.subplots(figsize=(15, 10))
+
+    plt.grid(True, linestyle='--', alpha=0.3, linewidth=1.5)
+
+    # Split the location's values by week and condition once instead of masking per group
+    grouped = {key: values.to_numpy()
+               for key, values in location_data.groupby(['Week', 'Condition'], observed=True)[percentage_col]}
+    week_conditions = location_data.groupby('Week', observed=True)['Condition'].unique().to_dict()
+    box_stats = group_box_stats(grouped)
+
+    valid_weeks = []
+    week_positions = {}
+    current_pos = 0
+
+    for week in all_weeks:
+        if week in week_conditions:
+            valid_weeks.append(week)
+            week_positions[week] = current_pos
+            current_pos += 1
+
+    condition_means = {condition: {} for condition in all_conditions}
+    condition_positions = {condition: {} for condition in all_conditions}
+    boxes = []
+
+    for week in valid_weeks:
+        conditions_in_week = sorted(week_conditions[week])
+        n_conditions = len(conditions_in_week)
+
+        for condition_idx, condition in enumerate(conditions_in_week):
+            values = grouped.get((week, condition), np.empty(0))
+
+            if len(values) > 0:
+                offset = 0.8 * (condition_idx - (n_conditions-1)/2) / n_conditions
+                pos = week_positions[week] + offset
+
+                condition_means[condition][week] = box_stats[(week, condition)][5]
+                condition_positions[condition][week] = pos
+
+                boxes.append((condition, pos, values, box_stats[(week, condition)]))
+
+    draw_condition_boxes(ax, boxes, derived_colors, marker_styles, point_size=20)
+
+    for condition in all_conditions:
+        weeks_with_data = sorted(condition_means[condition].keys())
+        for i in range(len(weeks_with_data) - 1):
+            current_week = weeks_with_data[i]
+            next_week = weeks_with_data[i + 1]
+
+            line_color = derived_colors[condition][0]
+
+            plt.plot([condition_positions[condition][current_week],
+                    condition_positions[condition][next_week]],
+                   [condition_means[condition][current_week],
+                    condition_means[condition][next_week]],
+                   color=line_color,
+                   linewidth=2.0,
+                   alpha=0.9,
+                   zorder=1)
+
+    plt.title(f'{segment_name} Analysis for {staining} Staining - {location}',
+             fontsize=30, fontweight='bold')
+    plt.xlabel('Week', fontsize=28, fontweight='bold')
+    plt.ylabel(f'{segment_name} Percentage', fontsize=28, fontweight='bold')
+
+    plt.xlim(-0.5, len(valid_weeks) - 0.5)
+    plt.xticks(range(len(valid_weeks)),
+              [f'Week {w}' for w in valid_weeks],
+              fontsize=24)
+    plt.yticks(fontsize=24)
+
+    present_conditions = set().union(*(week_conditions[w] for w in valid_weeks))
+    handles = []
+    for condition in all_conditions:
+        if condition in present_conditions:
+            box_color, marker_color = derived_colors[condition]
+
+            line = plt.Line2D([0], [0],
+                            color=box_color,
+                            marker=marker_styles[condition],
+                            markerfacecolor=marker_color,
+                            markeredgecolor='black',
+                            markeredgewidth=1,
+                            markersize=12,
+                            linewidth=2.0,
+                            label=condition)
+            handles.append(line)
+
+    ax.legend(handles=handles,
+             title='Condition',
+             loc='upper right',
+             fontsize=22,
+             title_fontsize=24)
+
+    plt.tight_layout()
+
+    fig.savefig(output_dir / f'{filename_base}_analysis.png',
+               dpi=PNG_DPI, bbox_inches='tight')
+    fig.savefig(output_dir / f'{filename_base}_analysis.svg',
+               format='svg', bbox_inches='tight')
+    plt.close(fig)
+
+    perform_statistical_analysis(location_data, staining, location,
+                              segment_name, percentage_col, output_dir,
+                              safe_location, safe_segment)
+
 def create_staining_plots(metadata_df, staining, output_dir):
-    plt.rcParams['figure.figsize'] = (15, 10)
-    plt.rcParams['axes.grid'] = True
-    plt.rcParams['grid.alpha'] = 0.3
-    plt.rcParams['grid.linestyle'] = '--'
+    plt.rcParams.update(PLOT_STYLE)
 
     STANDARD_COLORS = {
         'Sham': '#CC0000',
@@ -2014,7 +2590,8 @@ def create_staining_plots(metadata_df, staining, output_dir):
     available_markers = ['o', 's', '^', 'D', 'v', 'P', 'X', 'p', '*', 'h',
                         '+', 'x', '1', '2', '3', '4', '<', '>', 'H', 'd']
 
-    tile_data = pd.read_csv(Path(os.getenv('PROCESSED_FOLDER_PATH')) / f'{staining}_tile_data.csv')
+    tile_data_folder = Path(os.getenv('PROCESSED_FOLDER_PATH'))
+    tile_columns = read_tile_columns(tile_data_folder, staining)
 
     stain_data = metadata_df[metadata_df['Staining'] == staining].copy()
     locations = sorted(stain_data['Location'].unique())
@@ -2022,187 +2599,39 @@ def create_staining_plots(metadata_df, staining, output_dir):
     all_conditions = sorted(stain_data['Condition'].unique())
 
     condition_colors = {cond: STANDARD_COLORS.get(cond, '#808080') for cond in all_conditions}
+    derived_colors = derive_condition_colors(condition_colors)
     marker_styles = {condition: available_markers[idx % len(available_markers)]
                     for idx, condition in enumerate(sorted(all_conditions))}
 
-    percentage_columns = [col for col in tile_data.columns
+    percentage_columns = [col for col in tile_columns
                        if col.startswith(f"{staining}_") and col.endswith("_Percentage")]
+    segment_names = {col: col.replace(f"{staining}_", "").replace("_Percentage", "")
+                     for col in percentage_columns}
+    segment_stems = {col: sanitize_filename(name) for col, name in segment_names.items()}
+
+    # Workers read the tile table once each instead of receiving a copy with every task
+    plot_settings = {
+        'staining': staining,
+        'all_weeks': all_weeks,
+        'all_conditions': all_conditions,
+        'derived_colors': derived_colors,
+        'marker_styles': marker_styles,
+        'output_dir': output_dir,
+        'columns': TILE_KEY_COLUMNS + percentage_columns
+    }
+    tasks = [(location, col, segment_names[col], segment_stems[col])
+             for location in locations for col in percentage_columns]
 
-    for location in locations:
-        location_data = tile_data[tile_data['Location'] == location]
-
-        for percentage_col in percentage_columns:
-            segment_name = percentage_col.replace(f"{staining}_", "").replace("_Percentage", "")
-            safe_location = sanitize_filename(location)
-            safe_segment = sanitize_filename(segment_name)
-
-            plt.figure(figsize=(15, 10))
-            ax = plt.gca()
-
-            plt.grid(True, linestyle='--', alpha=0.3, linewidth=1.5)
-
-            valid_weeks = []
-            week_positions = {}
-            current_pos = 0
-
-            for week in all_weeks:
-                week_data = location_data[location_data['Week'] == week]
-                if len(week_data) > 0:
-                    valid_weeks.append(week)
-                    week_positions[week] = current_pos
-                    current_pos += 1
-
-            condition_means = {condition: {} for condition in all_conditions}
-            condition_positions = {condition: {} for condition in all_conditions}
-
-            for week in valid_weeks:
-                week_data = location_data[location_data['Week'] == week]
-                conditions_in_week = sorted(week_data['Condition'].unique())
-                n_conditions = len(conditions_in_week)
-
-                for condition_idx, condition in enumerate(conditions_in_week):
-                    condition_data = week_data[week_data['Condition'] == condition]
-                    values = condition_data[percentage_col]
-
-                    if len(values) > 0:
-                        offset = 0.8 * (condition_idx - (n_conditions-1)/2) / n_conditions
-                        pos = week_positions[week] + offset
-
-                        q1, median, q3 = np.percentile(values, [25, 50, 75])
-                        iqr = q3 - q1
-                        whisker_low = max(values.min(), q1 - 1.5 * iqr)
-                        whisker_high = min(values.max(), q3 + 1.5 * iqr)
-                        mean = values.mean()
-
-                        condition_means[condition][week] = mean
-                        condition_positions[condition][week] = pos
-
-                        base_color = condition_colors[condition]
-                        rgba = plt.matplotlib.colors.to_rgba(base_color)
-                        r, g, b, a = rgba
-                        box_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
-                        marker_color = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
-
-                        # Add jitter to points
-                        jitter = np.random.normal(0, 0.02, size=len(values))
-
-                        # Plot individual points with circles
-                        plt.scatter(pos + jitter, values,
-                                  marker='o',
-                                  color=marker_color,
-                                  edgecolor='black',
-                                  linewidth=1,
-                                  alpha=0.8,
-                                  s=20,
-                                  zorder=3)
-
-                        # Plot mean with condition-specific marker
-                        plt.plot([pos], [mean],
-                                marker=marker_styles[condition],
-                                color=box_color,
-                                markerfacecolor=marker_color,
-                                markeredgecolor='black',
-                                markeredgewidth=1,
-                                markersize=12,
-                                linewidth=2.0,
-                                alpha=0.9,
-                                zorder=4)
-
-                        box = plt.Rectangle((pos - 0.1, q1), 0.2, q3 - q1,
-                                         facecolor=box_color,
-                                         edgecolor='black',
-                                         linewidth=1,
-                                         alpha=1,
-                                         zorder=2)
-                        ax.add_patch(box)
-
-                        plt.hlines(median, pos - 0.1, pos + 0.1,
-                                 colors='black',
-                                 linewidth=2.0,
-                                 zorder=3)
-
-                        plt.vlines(pos, whisker_low, whisker_high,
-                                 colors=box_color,
-                                 linewidth=2.0,
-                                 zorder=2)
-                        plt.hlines([whisker_low, whisker_high],
-                                 pos - 0.1, pos + 0.1,
-                                 colors=box_color,
-                                 linewidth=2.0,
-                                 zorder=2)
-
-            for condition in all_conditions:
-                weeks_with_data = sorted(condition_means[condition].keys())
-                for i in range(len(weeks_with_data) - 1):
-                    current_week = weeks_with_data[i]
-                    next_week = weeks_with_data[i + 1]
-
-                    base_color = condition_colors[condition]
-                    rgba = plt.matplotlib.colors.to_rgba(base_color)
-                    r, g, b, a = rgba
-                    line_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
-
-                    plt.plot([condition_positions[condition][current_week],
-                            condition_positions[condition][next_week]],
-                           [condition_means[condition][current_week],
-                            condition_means[condition][next_week]],
-                           color=line_color,
-                           linewidth=2.0,
-                           alpha=0.9,
-                           zorder=1)
-
-            plt.title(f'{segment_name} Analysis for {staining} Staining - {location}',
-                     fontsize=30, fontweight='bold')
-            plt.xlabel('Week', fontsize=28, fontweight='bold')
-            plt.ylabel(f'{segment_name} Percentage', fontsize=28, fontweight='bold')
-
-            plt.xlim(-0.5, len(valid_weeks) - 0.5)
-            plt.xticks(range(len(valid_weeks)),
-                      [f'Week {w}' for w in valid_weeks],
-                      fontsize=24)
-            plt.yticks(fontsize=24)
-
-            handles = []
-            for condition in all_conditions:
-                if condition in set().union(*[
-                    set(location_data[location_data['Week'] == w]['Condition'].unique())
-                    for w in valid_weeks
-                ]):
-                    base_color = condition_colors[condition]
-                    rgba = plt.matplotlib.colors.to_rgba(base_color)
-                    r, g, b, a = rgba
-                    box_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
-                    marker_color = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
-
-                    line = plt.Line2D([0], [0],
-                                    color=box_color,
-                                    marker=marker_styles[condition],
-                                    markerfacecolor=marker_color,
-                                    markeredgecolor='black',
-                                    markeredgewidth=1,
-                                    markersize=12,
-                                    linewidth=2.0,
-                                    label=condition)
-                    handles.append(line)
-
-            ax.legend(handles=handles,
-                     title='Condition',
-                     loc='upper right',
-                     fontsize=22,
-                     title_fontsize=24)
-
-            plt.tight_layout()
-
-            filename_base = f'{staining}_{safe_location}_{safe_segment}'
-            plt.savefig(output_dir / f'{filename_base}_analysis.png',
-                       dpi=300, bbox_inches='tight')
-            plt.savefig(output_dir / f'{filename_base}_analysis.svg',
-                       format='svg', bbox_inches='tight')
-            plt.close()
-
-            perform_statistical_analysis(location_data, staining, location,
-                                      segment_name, percentage_col, output_dir,
-                                      safe_location, safe_segment)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_plot_worker,
+                             initargs=(tile_data_folder, plot_settings)) as executor:
+        futures = {executor.submit(plot_segment, task): task for task in tasks}
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Plotting {staining}"):
+            location, percentage_col = futures[future][:2]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error plotting {staining} - {location} - {percentage_col}: {e}")
 
 def process_tile_data(metadata_df):
 
@@ -2224,10 +2653,7 @@ def create_area_plots(metadata_df, output_dir):
         logger.error("ROIArea_sq_microns column not found in metadata")
         return
 
-    plt.rcParams['figure.figsize'] = (15, 10)
-    plt.rcParams['axes.grid'] = True
-    plt.rcParams['grid.alpha'] = 0.3
-    plt.rcParams['grid.linestyle'] = '--'
+    plt.rcParams.update(PLOT_STYLE)
 
     STANDARD_COLORS = {
         'Sham': '#CC0000',
@@ -2252,108 +2678,59 @@ def create_area_plots(metadata_df, output_dir):
     conditions = sorted(stain_data['Condition'].unique())
     weeks = sorted(stain_data['Week'].unique())
     condition_colors = {cond: STANDARD_COLORS.get(cond, '#808080') for cond in conditions}
+    derived_colors = derive_condition_colors(condition_colors)
     marker_styles = {condition: available_markers[idx % len(available_markers)]
                     for idx, condition in enumerate(sorted(conditions))}
 
-    plt.figure(figsize=(15, 10))
-    ax = plt.gca()
+    fig, ax = plt.subplots(figsize=(15, 10))
     plt.grid(True, linestyle='--', alpha=0.3, linewidth=1.5)
 
+    # Split the areas by week and condition once instead of masking per group
+    grouped = {key: values.to_numpy()
+               for key, values in stain_data.groupby(['Week', 'Condition'], observed=True)['Area_mm2']}
+    week_conditions = stain_data.groupby('Week', observed=True)['Condition'].unique().to_dict()
+    box_stats = group_box_stats(grouped)
+
     valid_weeks = []
     week_positions = {}
     current_pos = 0
 
     for week in weeks:
-        week_data = stain_data[stain_data['Week'] == week]
-        if len(week_data) > 0:
+        if week in week_conditions:
             valid_weeks.append(week)
             week_positions[week] = current_pos
             current_pos += 1
 
+    boxes = []
     for week in valid_weeks:
-        week_data = stain_data[stain_data['Week'] == week]
-        conditions_in_week = sorted(week_data['Condition'].unique())
+        conditions_in_week = sorted(week_conditions[week])
         n_conditions = len(conditions_in_week)
 
         for condition_idx, condition in enumerate(conditions_in_week):
-            condition_data = week_data[week_data['Condition'] == condition]['Area_mm2']
+            condition_data = grouped.get((week, condition), np.empty(0))
 
             if len(condition_data) > 0:
                 offset = 0.8 * (condition_idx - (n_conditions-1)/2) / n_conditions
                 pos = week_positions[week] + offset
 
-                q1, median, q3 = np.percentile(condition_data, [25, 50, 75])
-                iqr = q3 - q1
-                whisker_low = max(condition_data.min(), q1 - 1.5 * iqr)
-                whisker_high = min(condition_data.max(), q3 + 1.5 * iqr)
-                mean = condition_data.mean()
-
-                base_color = condition_colors[condition]
-                rgba = plt.matplotlib.colors.to_rgba(base_color)
-                r, g, b, a = rgba
-                box_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
-                marker_color = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
-
-                # Plot individual points with circles
-                jitter = np.random.normal(0, 0.02, size=len(condition_data))
-                plt.scatter(pos + jitter, condition_data,
-                          marker='o',
-                          color=marker_color,
-                          edgecolor='black',
-                          linewidth=1,
-                          alpha=0.8,
-                          s=50,
-                          zorder=3)
-
-                # Plot mean with condition-specific marker
-                plt.plot([pos], [mean],
-                        marker=marker_styles[condition],
-                        color=box_color,
-                        markerfacecolor=marker_color,
-                        markeredgecolor='black',
-                        markeredgewidth=1,
-                        markersize=12,
-                        linewidth=2.0,
-                        alpha=0.9,
-                        zorder=4)
-
-                box = plt.Rectangle((pos - 0.1, q1), 0.2, q3 - q1,
-                                 facecolor=box_color,
-                                 edgecolor='black',
-                                 linewidth=1,
-                                 alpha=1.0,
-                                 zorder=2)
-                ax.add_patch(box)
-
-                plt.hlines(median, pos - 0.1, pos + 0.1,
-                         colors='black',
-                         linewidth=2.0,
-                         zorder=3)
-
-                plt.vlines(pos, whisker_low, whisker_high,
-                         colors=box_color,
-                         linewidth=2.0,
-                         zorder=2)
-                plt.hlines([whisker_low, whisker_high],
-                         pos - 0.1, pos + 0.1,
-                         colors=box_color,
-                         linewidth=2.0,
-                         zorder=2)
+                mean = box_stats[(week, condition)][5]
+                box_color = derived_colors[condition][0]
+
+                boxes.append((condition, pos, condition_data, box_stats[(week, condition)]))
 
                 if week != valid_weeks[-1]:
-                    next_week_data = stain_data[
-                        (stain_data['Week'] == valid_weeks[valid_weeks.index(week) + 1]) &
-                        (stain_data['Condition'] == condition)
-                    ]['Area_mm2']
-                    if len(next_week_data) > 0:
-                        next_pos = week_positions[valid_weeks[valid_weeks.index(week) + 1]] + offset
-                        next_mean = next_week_data.mean()
+                    next_week = valid_weeks[valid_weeks.index(week) + 1]
+                    if (next_week, condition) in box_stats:
+                        next_pos = week_positions[next_week] + offset
+                        next_mean = box_stats[(next_week, condition)][5]
                         plt.plot([pos, next_pos], [mean, next_mean],
                                color=box_color,
                                linewidth=2.0,
                                alpha=0.9,
                                zorder=1)
 
+    draw_condition_boxes(ax, boxes, derived_colors, marker_styles, point_size=50)
+
     locations = sorted(stain_data['Location'].unique())
     location_info = f" ({', '.join(locations)})" if len(locations) > 1 else ""
 
@@ -2368,17 +2745,11 @@ def create_area_plots(metadata_df, output_dir):
               fontsize=24)
     plt.yticks(fontsize=24)
 
+    present_conditions = set().union(*(week_conditions[w] for w in valid_weeks))
     handles = []
     for condition in conditions:
-        if condition in set().union(*[
-            set(stain_data[stain_data['Week'] == w]['Condition'].unique())
-            for w in valid_weeks
-        ]):
-            base_color = condition_colors[condition]
-            rgba = plt.matplotlib.colors.to_rgba(base_color)
-            r, g, b, a = rgba
-            box_color = (min(1.0, r * 1.2), min(1.0, g * 1.2), min(1.0, b * 1.2), a)
-            marker_color = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
+        if condition in present_conditions:
+            box_color, marker_color = derived_colors[condition]
 
             line = plt.Line2D([0], [0],
                             color=box_color,
@@ -2399,11 +2770,11 @@ def create_area_plots(metadata_df, output_dir):
 
     plt.tight_layout()
 
-    plt.savefig(staining_dir / 'HE_area_analysis.png',
-               dpi=300, bbox_inches='tight')
-    plt.savefig(staining_dir / 'HE_area_analysis.svg',
+    fig.savefig(staining_dir / 'HE_area_analysis.png',
+               dpi=PNG_DPI, bbox_inches='tight')
+    fig.savefig(staining_dir / 'HE_area_analysis.svg',
                format='svg', bbox_inches='tight')
-    plt.close()
+    plt.close(fig)
 
     perform_statistical_analysis(stain_data, 'HE', "Combined Locations", "Area",
                               'Area_mm2', staining_dir,
@@ -2439,7 +2810,7 @@ def main():
 
     logger.info("Loading metadata...")
     metadata_path = base_path / 'metadata.csv'
-    metadata_df = pd.read_csv(metadata_path)
+    metadata_df = categorize_columns(pd.read_csv(metadata_path))
 
     logger.info("\nMetadata Overview:")
     logger.info(f"Total rows: {len(metadata_df)}")
@@ -2491,22 +2862,41 @@ if __name__ == "__main__":
 
 
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+from scipy import stats
 from pathlib import Path
 from google.colab import drive
 import os
 import logging
 import numpy as np
-from sklearn.linear_model import LinearRegression
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+# Numba compiles the pairwise weighted TPI tests when it is installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Known schema of the metadata columns the TPI analysis groups on
+METADATA_DTYPES = {'Staining': 'category', 'Condition': 'category', 'Location': 'category', 'Week': 'int16'}
+
 
+def is_tpi_column(column):
+    """Whether the TPI analysis reads a metadata column: the grouping labels and the percentage and SD values."""
+    return column in METADATA_DTYPES or column.endswith('_Percentage') or column.endswith('_SD')
+
+
+@lru_cache(maxsize=None)
 def get_marker_styles(conditions):
-    """Dynamically assign marker styles based on conditions in data."""
+    """Dynamically assign marker styles based on a tuple of the conditions in data."""
     available_markers = ['o', 's', '^', 'D', 'v', 'P', 'X', 'p', '*', 'h',
                          '+', 'x', '1', '2', '3', '4', '<', '>', 'H', 'd']
     marker_styles = {}
@@ -2515,8 +2905,9 @@ def get_marker_styles(conditions):
     return marker_styles
 
 
+@lru_cache(maxsize=None)
 def get_marker_colors(markers):
-    """Dynamically assign colors based on markers in data."""
+    """Dynamically assign colors based on a tuple of the markers in data."""
     fixed_condition_colors = {
         'Sham': '#E63946',  # Red
         'Ctrl': '#808080',  # Grey
@@ -2536,115 +2927,112 @@ def get_marker_colors(markers):
             additional_idx += 1
     return marker_colors
 
+def ols_residuals(x, y):
+    """Residuals of the least-squares line of y on a single predictor x."""
+    if len(x) != len(y):
+        raise ValueError(f"Inconsistent numbers of samples: {len(x)} predictor and {len(y)} response values")
+    x_centered = x - x.mean()
+    y_mean = y.mean()
+    sxx = (x_centered ** 2).sum()
+    # A constant predictor gets a flat fit, as LinearRegression gives
+    slope = (x_centered * (y - y_mean)).sum() / sxx if sxx > 0 else 0.0
+    return y - (y_mean + slope * x_centered)
+
+def mean_table(df, values):
+    """Mean of values by (Location, Week) rows and Condition columns, dropping all-NaN rows and columns as pivot_table does."""
+    table = df.groupby(['Location', 'Week', 'Condition'], observed=True)[values].mean().unstack('Condition')
+    return table.dropna(how='all').dropna(axis=1, how='all')
+
 def create_tpi_tables(he_means, marker_means_dict, nuclei_col, output_dir):
     """Create detailed tables of the data used in TPI calculations."""
     output_file = output_dir / 'analysis_summary.txt'
-    with open(output_file, 'w') as summary_file:
-        # 1. Create HE Nuclei percentage table
-        he_table = he_means.pivot_table(
-            values=nuclei_col,
-            index=['Location', 'Week'],
-            columns='Condition',
-            aggfunc='mean'
-        ).round(2)
-        summary_text = "\nTPI Analysis Summary Report\n"
-        summary_text += "==========================\n\n"
-        summary_text += "1. HE Nuclei Percentages\n"
-        summary_text += "-----------------------\n"
-        summary_text += he_table.to_string() + "\n\n"
-        print(summary_text)
-        summary_file.write(summary_text)
-
-        # 2. Process marker data
-        summary_text = "2. IHC Target Percentages\n"
-        summary_text += "-----------------------\n"
-        print(summary_text)
-        summary_file.write(summary_text)
-        for marker, data in marker_means_dict.items():
-            marker_table = data['means'].pivot_table(
-                values=data['target_col'],
-                index=['Location', 'Week'],
-                columns='Condition',
-                aggfunc='mean'
-            ).round(2)
-            marker_text = f"\n{marker} Target Percentages:\n"
-            marker_text += marker_table.to_string() + "\n\n"
-            print(marker_text)
-            summary_file.write(marker_text)
-
-        # 3. Create TPI tables
-        summary_text = "3. Target Prevalence Index (TPI) Values\n"
-        summary_text += "------------------------------------\n"
-        print(summary_text)
-        summary_file.write(summary_text)
-        for marker, data in marker_means_dict.items():
-            tpi_data = []
-            for location in data['means']['Location'].unique():
-                for condition in data['means']['Condition'].unique():
-                    marker_subset = data['means'][
-                        (data['means']['Location'] == location) &
-                        (data['means']['Condition'] == condition)
-                    ]
-                    he_subset = he_means[
-                        (he_means['Location'] == location) &
-                        (he_means['Condition'] == condition)
-                    ]
-                    if not marker_subset.empty and not he_subset.empty:
-                        for week in marker_subset['Week'].unique():
-                            week_marker = marker_subset[marker_subset['Week'] == week][data['target_col']]
-                            week_he = he_subset[he_subset['Week'] == week][nuclei_col]
-                            if not week_marker.empty and not week_he.empty:
-                                week_tpis = []
-                                for m in week_marker:
-                                    for h in week_he:
-                                        if h != 0:  # Avoid division by zero
-                                            week_tpis.append(m / h)
-                                if week_tpis:
-                                    tpi_data.append({
-                                        'Location': location,
-                                        'Condition': condition,
-                                        'Week': week,
-                                        'TPI': np.mean(week_tpis),
-                                        'TPI_SD': np.std(week_tpis, ddof=1) if len(week_tpis) > 1 else 0
-                                    })
-            if tpi_data:
-                tpi_df = pd.DataFrame(tpi_data)
-                tpi_table = tpi_df.pivot_table(
-                    values=['TPI', 'TPI_SD'],
-                    index=['Location', 'Week'],
-                    columns='Condition',
-                    aggfunc={'TPI': 'mean', 'TPI_SD': 'mean'}
-                ).round(3)
-                tpi_text = f"\n{marker} TPI Values:\n"
-                tpi_text += tpi_table.to_string() + "\n\n"
-                print(tpi_text)
-                summary_file.write(tpi_text)
-
-                # 4. Add statistics
-                stats_text = "4. Statistical Summary\n"
-                stats_text += "-------------------\n"
-                print(stats_text)
-                summary_file.write(stats_text)
-                stats_data = {
-                    'Max TPI': tpi_df['TPI'].max(),
-                    'Min TPI': tpi_df['TPI'].min(),
-                    'Mean TPI': tpi_df['TPI'].mean(),
-                    'Median TPI': tpi_df['TPI'].median(),
-                    'Overall Std Dev': tpi_df['TPI'].std(),
-                    'Average Within-Week Std Dev': tpi_df['TPI_SD'].mean()
-                }
-                for stat, value in stats_data.items():
-                    stat_line = f"{stat}: {value:.3f}\n"
-                    print(stat_line)
-                    summary_file.write(stat_line)
-                print("\n")
-                summary_file.write("\n")
-
-def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_colors, marker_styles, ax):
-    """
-    Create an improved plot for a single marker with distinct colors for boxes and markers.
-    Individual lines connect consecutive boxes.
-    """
+    # Collect the report parts, then print and write them once at the end
+    parts = []
+
+    # 1. Create HE Nuclei percentage table
+    he_table = mean_table(he_means, nuclei_col).round(2)
+    summary_text = "\nTPI Analysis Summary Report\n"
+    summary_text += "==========================\n\n"
+    summary_text += "1. HE Nuclei Percentages\n"
+    summary_text += "-----------------------\n"
+    summary_text += he_table.to_string() + "\n\n"
+    parts.append(summary_text)
+
+    # 2. Process marker data
+    summary_text = "2. IHC Target Percentages\n"
+    summary_text += "-----------------------\n"
+    parts.append(summary_text)
+    for marker, data in marker_means_dict.items():
+        marker_table = mean_table(data['means'], data['target_col']).round(2)
+        marker_text = f"\n{marker} Target Percentages:\n"
+        marker_text += marker_table.to_string() + "\n\n"
+        parts.append(marker_text)
+
+    # 3. Create TPI tables
+    summary_text = "3. Target Prevalence Index (TPI) Values\n"
+    summary_text += "------------------------------------\n"
+    parts.append(summary_text)
+    # Look the HE means up by key instead of masking he_means for every group
+    he_groups = {key: values.to_numpy() for key, values in
+                 he_means.groupby(['Location', 'Condition', 'Week'], sort=False, observed=True)[nuclei_col]}
+    for marker, data in marker_means_dict.items():
+        ratio_keys = []
+        ratio_values = []
+        marker_groups = dict(list(data['means'].groupby(['Location', 'Condition'], sort=False, observed=True)))
+        for location in data['means']['Location'].unique():
+            for condition in data['means']['Condition'].unique():
+                marker_subset = marker_groups.get((location, condition))
+                if marker_subset is not None:
+                    for week, week_marker in marker_subset.groupby('Week', sort=False)[data['target_col']]:
+                        week_he = he_groups.get((location, condition, week))
+                        if week_he is not None:
+                            he_values = week_he[week_he != 0]  # Avoid division by zero
+                            # Every marker value over every HE value in one broadcast
+                            week_tpis = (week_marker.to_numpy()[:, None] / he_values[None, :]).ravel()
+                            if week_tpis.size:
+                                ratio_keys.append((location, condition, week))
+                                ratio_values.append(week_tpis)
+        if ratio_values:
+            # Long-form ratios, then the mean and SD of every group in one aggregation
+            group_keys = pd.DataFrame(ratio_keys, columns=['Location', 'Condition', 'Week'])
+            ratios_df = group_keys.loc[group_keys.index.repeat([len(values) for values in ratio_values])].reset_index(drop=True)
+            ratios_df['ratio'] = np.concatenate(ratio_values)
+            tpi_stats = (ratios_df.groupby(['Location', 'Condition', 'Week'], sort=False, observed=True)['ratio']
+                         .agg(['mean', 'std', 'count', 'size']))
+            # A single ratio has no spread; agg skips NaN, so groups with missing ratios are set back to NaN
+            tpi_stats.loc[tpi_stats['count'] == 1, 'std'] = 0.0
+            tpi_stats.loc[tpi_stats['count'] < tpi_stats['size'], ['mean', 'std']] = np.nan
+            tpi_df = (tpi_stats[['mean', 'std']].reset_index()
+                      .rename(columns={'mean': 'TPI', 'std': 'TPI_SD'}))
+            tpi_table = mean_table(tpi_df, ['TPI', 'TPI_SD']).round(3)
+            tpi_text = f"\n{marker} TPI Values:\n"
+            tpi_text += tpi_table.to_string() + "\n\n"
+            parts.append(tpi_text)
+
+            # 4. Add statistics
+            stats_text = "4. Statistical Summary\n"
+            stats_text += "-------------------\n"
+            parts.append(stats_text)
+            stats_data = {
+                'Max TPI': tpi_df['TPI'].max(),
+                'Min TPI': tpi_df['TPI'].min(),
+                'Mean TPI': tpi_df['TPI'].mean(),
+                'Median TPI': tpi_df['TPI'].median(),
+                'Overall Std Dev': tpi_df['TPI'].std(),
+                'Average Within-Week Std Dev': tpi_df['TPI_SD'].mean()
+            }
+            for stat, value in stats_data.items():
+                stat_line = f"{stat}: {value:.3f}\n"
+                parts.append(stat_line)
+            parts.append("\n")
+
+    # Print each part on its own line and write the report in one call
+    print('\n'.join(parts))
+    output_file.write_text(''.join(parts))
+
+@lru_cache(maxsize=None)
+def condition_palette(conditions):
+    """Box colors, marker colors and box offsets of a sorted tuple of conditions, shared by all markers."""
     # Define fixed colors for known conditions
     base_colors = {
         'Sham': '#CC0000',    # Base red
@@ -2659,9 +3047,11 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
     # Create color mappings section of the function:
     box_colors = {}
     marker_colors = {}
+    offsets = {}
     fallback_idx = 0
+    n_conditions = len(conditions)
 
-    for condition in sorted(conditions):
+    for condition_idx, condition in enumerate(conditions):
         if condition in base_colors:
             base_color = base_colors[condition]
         else:
@@ -2680,6 +3070,18 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
         darker_rgba = (max(0, r * 0.8), max(0, g * 0.8), max(0, b * 0.8), a)
         marker_colors[condition] = darker_rgba
 
+        # Horizontal offset of this condition's boxes within a week
+        offsets[condition] = 0.8 * (condition_idx - (n_conditions-1)/2) / n_conditions
+
+    return box_colors, marker_colors, offsets
+
+def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_colors, marker_styles, ax):
+    """
+    Create an improved plot for a single marker with distinct colors for boxes and markers.
+    Individual lines connect consecutive boxes.
+    """
+    box_colors, marker_colors, offsets = condition_palette(tuple(sorted(conditions)))
+
     # Plot settings
     marker_size = 50
     line_width = 2.0
@@ -2688,24 +3090,22 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
 
     # Create week position mapping
     week_positions = {week: i for i, week in enumerate(unique_weeks)}
-    n_conditions = len(conditions)
 
     # Plot for each condition
-    for condition_idx, condition in enumerate(sorted(conditions)):
-        # Calculate offset for this condition
-        offset = 0.8 * (condition_idx - (n_conditions-1)/2) / n_conditions
-        condition_data = marker_data[marker_data['Condition'] == condition].copy()
+    for condition in sorted(conditions):
+        offset = offsets[condition]
+        condition_data = marker_data[marker_data['Condition'] == condition]
 
         if condition_data.empty:
             continue
 
-        # Add position column for plotting
-        condition_data['plot_position'] = condition_data['Week'].map(week_positions)
+        # Plot positions of the points, kept outside the filtered frame
+        plot_positions = condition_data['Week'].map(week_positions).to_numpy()
 
         # 1. Plot scatter points
         ax.scatter(
-            [week_positions[week] + offset for week in condition_data['Week']],
-            condition_data['TPI'],
+            plot_positions + offset,
+            condition_data['TPI'].to_numpy(),
             color=marker_colors[condition],
             edgecolor='black',
             linewidth=edge_width,
@@ -2717,6 +3117,7 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
         # 2. Plot boxes for each week
         means_data = []
         positions = []
+        box_values = []
 
         for week in unique_weeks:
             week_data = condition_data[condition_data['Week'] == week]['TPI']
@@ -2724,70 +3125,49 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
                 current_mean = week_data.mean()
                 means_data.append(current_mean)
                 positions.append(week_positions[week] + offset)
+                box_values.append(week_data)
+
+        # One boxplot call draws all of the condition's weeks
+        if box_values:
+            ax.boxplot(
+                box_values,
+                positions=positions,
+                widths=box_width,
+                patch_artist=True,
+                medianprops={'color': 'black', 'linewidth': line_width},
+                boxprops={
+                    'facecolor': box_colors[condition],
+                    'alpha': 1.0,
+                    'linewidth': line_width,
+                    'edgecolor': 'black'
+                },
+                whiskerprops={'color': 'black', 'linewidth': line_width},
+                capprops={'color': 'black', 'linewidth': line_width},
+                flierprops={
+                    'marker': 'o',
+                    'markerfacecolor': box_colors[condition],
+                    'markeredgecolor': 'black',
+                    'markersize': 4,
+                    'alpha': 1.0
+                },
+                zorder=2,
+                showfliers=False
+            )
 
-                ax.boxplot(
-                    [week_data],
-                    positions=[week_positions[week] + offset],
-                    widths=box_width,
-                    patch_artist=True,
-                    medianprops={'color': 'black', 'linewidth': line_width},
-                    boxprops={
-                        'facecolor': box_colors[condition],
-                        'alpha': 1.0,
-                        'linewidth': line_width,
-                        'edgecolor': 'black'
-                    },
-                    whiskerprops={'color': 'black', 'linewidth': line_width},
-                    capprops={'color': 'black', 'linewidth': line_width},
-                    flierprops={
-                        'marker': 'o',
-                        'markerfacecolor': box_colors[condition],
-                        'markeredgecolor': 'black',
-                        'markersize': 4,
-                        'alpha': 1.0
-                    },
-                    zorder=2,
-                    showfliers=False
-                )
-
-        # 3. Plot individual lines between consecutive means
+        # 3. Plot the line through the weekly means and its markers as one artist
         if len(means_data) > 1:
-            for i in range(len(means_data) - 1):
-                # Plot individual line segments
-                ax.plot(
-                    [positions[i], positions[i+1]],
-                    [means_data[i], means_data[i+1]],
-                    color=box_colors[condition],
-                    linewidth=line_width,
-                    alpha=0.9,
-                    zorder=4
-                )
-
-                # Plot markers at each point
-                ax.plot(
-                    positions[i],
-                    means_data[i],
-                    color=box_colors[condition],
-                    marker=marker_styles[condition],
-                    markerfacecolor=marker_colors[condition],
-                    markeredgecolor='black',
-                    markeredgewidth=edge_width,
-                    markersize=12,
-                    zorder=5,
-                    label=condition if i == 0 else ""  # Only add label for first point
-                )
-
-            # Plot the last marker separately
             ax.plot(
-                positions[-1],
-                means_data[-1],
+                positions,
+                means_data,
                 color=box_colors[condition],
+                linewidth=line_width,
                 marker=marker_styles[condition],
                 markerfacecolor=marker_colors[condition],
                 markeredgecolor='black',
                 markeredgewidth=edge_width,
                 markersize=12,
-                zorder=5
+                zorder=5,
+                label=condition
             )
 
     # Style the plot
@@ -2812,6 +3192,103 @@ def create_marker_plot(marker_data, conditions, unique_weeks, marker, condition_
 
     return ax
 
+# Per-process state of the TPI marker workers, filled by init_tpi_worker
+tpi_worker_state = {}
+
+def init_tpi_worker(staining_groups, tpi_settings):
+    """Keep the metadata of every stain, the shared settings and one reusable marker figure in each worker."""
+    tpi_worker_state['staining_groups'] = staining_groups
+    tpi_worker_state['settings'] = tpi_settings
+    tpi_worker_state['figure'] = plt.subplots(figsize=(15, 10))
+
+def render_marker(marker):
+    """Compute a marker's TPI values, test them and save its plot; returns the marker's summary or None."""
+    settings = tpi_worker_state['settings']
+    conditions = settings['conditions']
+    unique_weeks = settings['unique_weeks']
+    he_groups = settings['he_groups']
+    marker_styles = settings['marker_styles']
+    output_dir = settings['output_dir']
+
+    marker_data = tpi_worker_state['staining_groups'].get(marker)
+    if marker_data is None:
+        return None
+
+    target_col = [col for col in marker_data.columns
+                 if col.startswith(f'{marker}_Target')
+                 and col.endswith('_Percentage')]
+
+    if not target_col:
+        logger.warning(f"No target percentage column found for {marker}")
+        return None
+
+    target_col = target_col[0]
+    marker_sd_col = target_col.replace('Percentage', 'SD')
+
+    # Calculate regression-based TPI values, one array per condition/week/location group,
+    # with the marker SD weights (inverse of variance) of the same rows
+    tpi_keys = []
+    tpi_values = []
+    tpi_weights = []
+    marker_groups = dict(list(marker_data.groupby(['Condition', 'Week'], sort=False, observed=True)))
+    for condition in conditions:
+        for week in unique_weeks:
+            condition_data = marker_groups.get((condition, week))
+
+            if condition_data is not None:
+                # Perform regression for each location
+                for location, loc_rows in condition_data.groupby('Location', sort=False, observed=True):
+                    loc_he = he_groups.get((condition, week, location))
+
+                    if loc_he is not None:
+                        # For each condition/week/location combination
+                        y = loc_rows[target_col].values     # Dependent variable (marker)
+                        if len(loc_he) != len(y):
+                            # The regression pairs values one to one, so unequal groups cannot be fitted
+                            logger.warning(f"Skipping {marker} {condition} week {week} {location}: "
+                                           f"{len(y)} marker values but {len(loc_he)} HE values")
+                            continue
+                        residuals = ols_residuals(loc_he, y)  # Nuclei as the predictor
+
+                        tpi_keys.append((location, condition, week))
+                        tpi_values.append(residuals + np.mean(y))  # Center around original mean
+                        tpi_weights.append(1 / (loc_rows[marker_sd_col].to_numpy() ** 2))
+
+    if tpi_values:
+        # One row per individual point, repeating its group's keys
+        group_keys = pd.DataFrame(tpi_keys, columns=['Location', 'Condition', 'Week'])
+        tpi_df = group_keys.loc[group_keys.index.repeat([len(values) for values in tpi_values])].reset_index(drop=True)
+        tpi_df['TPI'] = np.concatenate(tpi_values)
+        tpi_df['Weight'] = np.concatenate(tpi_weights)
+        marker_means = marker_data.groupby(['Location', 'Week', 'Condition'], observed=True)[target_col].mean().reset_index()
+        marker_summary = {
+            'means': marker_means,
+            'target_col': target_col,
+            'tpi_data': tpi_df
+        }
+        perform_weighted_tpi_statistical_analysis(tpi_df, marker, output_dir)
+
+        # The worker's figure is cleared after every marker instead of being rebuilt
+        fig, ax = tpi_worker_state['figure']
+
+        condition_colors = {
+            condition: plt.cm.Set2(i/len(conditions))
+            for i, condition in enumerate(sorted(conditions))
+        }
+
+        create_marker_plot(tpi_df, conditions, unique_weeks, marker,
+                           condition_colors, marker_styles, ax)
+
+        fig.tight_layout()
+        fig.savefig(output_dir / f'target_prevalence_index_{marker}.png',
+                   dpi=300, bbox_inches='tight')
+        fig.savefig(output_dir / f'target_prevalence_index_{marker}.svg',
+                   format='svg', bbox_inches='tight')
+        ax.clear()
+
+        return marker_summary
+    return None
+
 def create_tpi_plots(metadata_df, output_dir):
     """Create Target Prevalence Index (TPI) plots from metadata."""
     plt.rcParams['figure.figsize'] = (15, 10)
@@ -2825,7 +3302,8 @@ def create_tpi_plots(metadata_df, output_dir):
     ihc_stains = ['Laminin', 'MHC', 'Collagen', 'Actinin', 'CD31', 'Acetylc',
                   'Tubulin', 'CD68', 'FSP1', 'Desmin']
 
-    tile_df = metadata_df.copy()
+    # Categorical labels let the groupby calls below work on integer codes
+    tile_df = metadata_df.astype({column: 'category' for column in ['Condition', 'Location', 'Staining']})
     staining_types = sorted(tile_df['Staining'].unique())
     ihc_markers = sorted([s for s in staining_types if s in ihc_stains])
     conditions = sorted(tile_df['Condition'].unique())
@@ -2834,8 +3312,9 @@ def create_tpi_plots(metadata_df, output_dir):
     logger.info(f"Found IHC markers to analyze: {ihc_markers}")
     logger.info(f"Found conditions: {conditions}")
 
-    marker_styles = get_marker_styles(conditions)
-    marker_colors = get_marker_colors(ihc_markers)
+    # Copies, so the fill-ins below do not change the cached mappings
+    marker_styles = dict(get_marker_styles(tuple(conditions)))
+    marker_colors = dict(get_marker_colors(tuple(ihc_markers)))
 
     for condition in conditions:
         if condition not in marker_styles:
@@ -2845,7 +3324,9 @@ def create_tpi_plots(metadata_df, output_dir):
         if marker not in marker_colors:
             marker_colors[marker] = '#808080'
 
-    he_data = tile_df[tile_df['Staining'] == 'HE'].copy()
+    # Split the metadata by stain once; markers look their rows up by name
+    staining_groups = dict(list(tile_df.groupby('Staining', sort=False, observed=True)))
+    he_data = staining_groups.get('HE', tile_df.iloc[:0])
     nuclei_col = [col for col in he_data.columns if col.startswith('HE_') and 'Nuclei' in col and col.endswith('_Percentage')]
 
     if not nuclei_col:
@@ -2853,88 +3334,33 @@ def create_tpi_plots(metadata_df, output_dir):
         return
     nuclei_col = nuclei_col[0]
 
-    he_means = he_data.groupby(['Condition', 'Week', 'Location'])[nuclei_col].mean().reset_index()
+    he_means = he_data.groupby(['Condition', 'Week', 'Location'], observed=True)[nuclei_col].mean().reset_index()
+    he_groups = {key: values.to_numpy() for key, values in
+                 he_data.groupby(['Condition', 'Week', 'Location'], sort=False, observed=True)[nuclei_col]}
     marker_means_dict = {}
 
-    for marker in ihc_markers:
-        marker_data = tile_df[tile_df['Staining'] == marker].copy()
-        if len(marker_data) == 0:
-            continue
-
-        target_col = [col for col in marker_data.columns
-                     if col.startswith(f'{marker}_Target')
-                     and col.endswith('_Percentage')]
-
-        if not target_col:
-            logger.warning(f"No target percentage column found for {marker}")
-            continue
-
-        target_col = target_col[0]
-
-        # Calculate regression-based TPI values
-        tpi_data = []
-        for condition in conditions:
-            for week in unique_weeks:
-                condition_data = marker_data[
-                    (marker_data['Condition'] == condition) &
-                    (marker_data['Week'] == week)
-                ]
-
-                matching_he = he_data[
-                    (he_data['Condition'] == condition) &
-                    (he_data['Week'] == week)
-                ]
-
-                if not condition_data.empty and not matching_he.empty:
-                    # Perform regression for each location
-                    for location in condition_data['Location'].unique():
-                        loc_marker = condition_data[condition_data['Location'] == location][target_col].values
-                        loc_he = matching_he[matching_he['Location'] == location][nuclei_col].values
-
-                        if len(loc_marker) > 0 and len(loc_he) > 0:
-                            # For each condition/week/location combination
-                            X = loc_he.reshape(-1, 1)  # Independent variable (nuclei)
-                            y = loc_marker            # Dependent variable (marker)
-                            reg = LinearRegression()
-                            reg.fit(X, y)
-                            residuals = y - reg.predict(X)
-
-                            # Append each individual point
-                            for i in range(len(residuals)):
-                                tpi_data.append({
-                                    'Location': location,
-                                    'Condition': condition,
-                                    'Week': week,
-                                    'TPI': residuals[i] + np.mean(y)  # Center around original mean
-                                })
-
-        if tpi_data:
-            tpi_df = pd.DataFrame(tpi_data)
-            marker_means = marker_data.groupby(['Location', 'Week', 'Condition'])[target_col].mean().reset_index()
-            marker_means_dict[marker] = {
-                'means': marker_means,
-                'target_col': target_col,
-                'tpi_data': tpi_df
-            }
-            perform_weighted_tpi_statistical_analysis(tpi_df, marker_data, target_col, marker, output_dir)
-
-            plt.figure(figsize=(15, 10))
-            ax = plt.gca()
-
-            condition_colors = {
-                condition: plt.cm.Set2(i/len(conditions))
-                for i, condition in enumerate(sorted(conditions))
-            }
-
-            create_marker_plot(tpi_df, conditions, unique_weeks, marker,
-                               condition_colors, marker_styles, ax)
+    # Markers are independent, so their TPI values, tests and plots are computed in parallel
+    tpi_settings = {
+        'conditions': conditions,
+        'unique_weeks': unique_weeks,
+        'he_groups': he_groups,
+        'marker_styles': marker_styles,
+        'output_dir': output_dir
+    }
+    if ihc_markers:
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(ihc_markers)),
+                                 initializer=init_tpi_worker, initargs=(staining_groups, tpi_settings)) as executor:
+            futures = [executor.submit(render_marker, marker) for marker in ihc_markers]
 
-            plt.tight_layout()
-            plt.savefig(output_dir / f'target_prevalence_index_{marker}.png',
-                       dpi=300, bbox_inches='tight')
-            plt.savefig(output_dir / f'target_prevalence_index_{marker}.svg',
-                       format='svg', bbox_inches='tight')
-            plt.close()
+            # Results are taken in marker order; a failing marker is logged and left out
+            for marker, future in zip(ihc_markers, futures):
+                try:
+                    marker_summary = future.result()
+                except Exception as e:
+                    logger.error(f"Error analyzing TPI for {marker}: {e}")
+                    continue
+                if marker_summary is not None:
+                    marker_means_dict[marker] = marker_summary
 
     # Create combined plot if needed
     if len(marker_means_dict) > 0:
@@ -2942,12 +3368,17 @@ def create_tpi_plots(metadata_df, output_dir):
         ax = plt.gca()
         week_positions = {week: i for i, week in enumerate(unique_weeks)}
 
-        for marker, data in marker_means_dict.items():
-            tpi_df = data['tpi_data']
+        # Group the TPI values of all markers once instead of filtering per marker, condition and week
+        combined = pd.concat([data['tpi_data'].assign(Marker=marker)
+                              for marker, data in marker_means_dict.items()], ignore_index=True)
+        condition_groups = dict(list(combined.groupby(['Marker', 'Condition'], sort=False, observed=True)))
+        week_groups = {key: values.to_numpy() for key, values in
+                       combined.groupby(['Marker', 'Condition', 'Week'], sort=False, observed=True)['TPI']}
 
+        for marker in marker_means_dict:
             for condition in conditions:
-                condition_data = tpi_df[tpi_df['Condition'] == condition]
-                if len(condition_data) > 0:
+                condition_data = condition_groups.get((marker, condition))
+                if condition_data is not None:
                     means = []
                     plot_positions = []
 
@@ -2956,34 +3387,37 @@ def create_tpi_plots(metadata_df, output_dir):
                     offset = 0.4 * (condition_idx - (n_conditions-1)/2) / n_conditions
 
                     ax.scatter(
-                        [week_positions[week] + offset for week in condition_data['Week']],
-                        condition_data['TPI'],
+                        condition_data['Week'].map(week_positions).to_numpy() + offset,
+                        condition_data['TPI'].to_numpy(),
                         color=marker_colors[marker],
                         alpha=0.4,
                         s=20,
                         zorder=3
                     )
 
+                    box_values = []
                     for week in unique_weeks:
-                        week_data = condition_data[condition_data['Week'] == week]['TPI']
-                        if not week_data.empty:
+                        week_data = week_groups.get((marker, condition, week))
+                        if week_data is not None:
                             means.append(week_data.mean())
                             plot_positions.append(week_positions[week])
-
-                            ax.boxplot(
-                                [week_data],
-                                positions=[week_positions[week] + offset],
-                                widths=0.2,
-                                patch_artist=True,
-                                medianprops=dict(color='black'),
-                                boxprops=dict(facecolor=marker_colors[marker], alpha=0.3),
-                                whiskerprops=dict(color=marker_colors[marker]),
-                                capprops=dict(color=marker_colors[marker]),
-                                flierprops=dict(marker='o', markerfacecolor=marker_colors[marker],
-                                                markersize=4, alpha=0.5),
-                                zorder=2,
-                                showfliers=False
-                            )
+                            box_values.append(week_data)
+
+                    if box_values:
+                        ax.boxplot(
+                            box_values,
+                            positions=[p + offset for p in plot_positions],
+                            widths=0.2,
+                            patch_artist=True,
+                            medianprops=dict(color='black'),
+                            boxprops=dict(facecolor=marker_colors[marker], alpha=0.3),
+                            whiskerprops=dict(color=marker_colors[marker]),
+                            capprops=dict(color=marker_colors[marker]),
+                            flierprops=dict(marker='o', markerfacecolor=marker_colors[marker],
+                                            markersize=4, alpha=0.5),
+                            zorder=2,
+                            showfliers=False
+                        )
 
                     if means:
                         plt.plot([p + offset for p in plot_positions], means,
@@ -3020,17 +3454,35 @@ def create_tpi_plots(metadata_df, output_dir):
 
     return output_dir
 
-def perform_weighted_tpi_statistical_analysis(tpi_df, marker_data, target_col, marker, output_dir):
+if njit is not None:
+    # error_model='numpy' gives inf/nan on division by zero, as the NumPy path does
+    @njit(error_model='numpy')
+    def weighted_pair_statistics(n, mean, var, pair_i, pair_j):
+        """t statistic, pooled SE and conservative df of the weighted comparison of every group pair."""
+        t_stat = np.empty(pair_i.shape[0])
+        se = np.empty(pair_i.shape[0])
+        df = np.empty(pair_i.shape[0])
+        for k in range(pair_i.shape[0]):
+            i = pair_i[k]
+            j = pair_j[k]
+            se[k] = np.sqrt(var[i] + var[j])
+            t_stat[k] = (mean[i] - mean[j]) / se[k]
+            df[k] = min(n[i], n[j]) - 1
+        return t_stat, se, df
+else:
+    def weighted_pair_statistics(n, mean, var, pair_i, pair_j):
+        """t statistic, pooled SE and conservative df of the weighted comparison of every group pair."""
+        se = np.sqrt(var[pair_i] + var[pair_j])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_stat = (mean[pair_i] - mean[pair_j]) / se
+        df = np.minimum(n[pair_i], n[pair_j]) - 1
+        return t_stat, se, df
+
+def perform_weighted_tpi_statistical_analysis(tpi_df, marker, output_dir):
     """
-    Performs statistical analysis using weighted t-tests with weights from original measurement SDs.
+    Performs statistical analysis using weighted t-tests with weights from original measurement SDs,
+    carried in tpi_df's Weight column next to each TPI value.
     """
-    import statsmodels.api as sm
-    from scipy import stats
-    from statsmodels.stats.multitest import multipletests
-    import numpy as np
-    import seaborn as sns
-    import matplotlib.pyplot as plt
-
     FONT_SIZE = {
         'title': 18,
         'axes_labels': 16,
@@ -3044,19 +3496,10 @@ def perform_weighted_tpi_statistical_analysis(tpi_df, marker_data, target_col, m
     print(f"\nPerforming TPI statistical analysis for {marker}")
     print(f"Number of weeks to analyze: {len(weeks)}")
 
-    # Create comprehensive p-value matrix across all timepoints
-    all_groups = []
-    for week in weeks:
-        week_data = tpi_df[tpi_df['Week'] == week]
-        conditions = sorted(week_data['Condition'].unique())
-        for condition in conditions:
-            if len(week_data[week_data['Condition'] == condition]) > 0:
-                all_groups.append(f"{condition}_W{week}")
-
-    comprehensive_matrix = pd.DataFrame(1.0, index=all_groups, columns=all_groups)
-
-    # Get SD column names
-    marker_sd_col = target_col.replace('Percentage', 'SD')
+    # Create comprehensive p-value matrix across all timepoints, one group per
+    # week and condition with TPI values, ordered by week and then condition
+    tpi_groups = dict(list(tpi_df.groupby(['Week', 'Condition'], observed=True)[['TPI', 'Weight']]))
+    all_groups = [f"{condition}_W{week}" for week, condition in tpi_groups]
 
     results.extend([
         "COMPREHENSIVE ANALYSIS ACROSS ALL TIME POINTS",
@@ -3068,53 +3511,29 @@ def perform_weighted_tpi_statistical_analysis(tpi_df, marker_data, target_col, m
         "\nPairwise Comparisons:"
     ])
 
-    from itertools import combinations
-    pairs = list(combinations(all_groups, 2))
-
-    for group1, group2 in pairs:
-        cond1, week1 = group1.rsplit('_W', 1)
-        cond2, week2 = group2.rsplit('_W', 1)
-
-        # Get TPI values and corresponding weights from marker SDs
-        group1_tpi = tpi_df[(tpi_df['Week'] == int(week1)) &
-                           (tpi_df['Condition'] == cond1)]
-        group2_tpi = tpi_df[(tpi_df['Week'] == int(week2)) &
-                           (tpi_df['Condition'] == cond2)]
-
-        # Get corresponding marker data for weights
-        group1_marker = marker_data[(marker_data['Week'] == int(week1)) &
-                                  (marker_data['Condition'] == cond1)]
-        group2_marker = marker_data[(marker_data['Week'] == int(week2)) &
-                                  (marker_data['Condition'] == cond2)]
-
-        if len(group1_tpi) > 0 and len(group2_tpi) > 0:
-            # Get weights from marker SDs (inverse of variance)
-            weights1 = 1 / (group1_marker[marker_sd_col].values ** 2)
-            weights2 = 1 / (group2_marker[marker_sd_col].values ** 2)
-
-            # Calculate weighted means
-            weighted_mean1 = np.average(group1_tpi['TPI'], weights=weights1)
-            weighted_mean2 = np.average(group2_tpi['TPI'], weights=weights2)
-
-            # Calculate weighted variances
-            weighted_var1 = np.average((group1_tpi['TPI'] - weighted_mean1) ** 2, weights=weights1)
-            weighted_var2 = np.average((group2_tpi['TPI'] - weighted_mean2) ** 2, weights=weights2)
-
-            # Calculate pooled SE
-            se = np.sqrt(weighted_var1 + weighted_var2)
-
-            if se == 0:
-                p_value = 1.0
-            else:
-                # Calculate t-statistic
-                t_stat = (weighted_mean1 - weighted_mean2) / se
-                # Use conservative df = min(n1, n2) - 1
-                df = min(len(group1_tpi), len(group2_tpi)) - 1
-                p_value = 2 * (1 - stats.t.cdf(abs(t_stat), df))
-
-            comprehensive_matrix.loc[group1, group2] = p_value
-            comprehensive_matrix.loc[group2, group1] = p_value
-            results.append(f"{group1} vs {group2}: p-value = {p_value:.6f}")
+    # Weighted mean and variance of each group once, not once per pair it is in;
+    # each TPI value keeps the weight of the marker row it was computed from
+    group_n = np.empty(len(all_groups))
+    group_mean = np.empty(len(all_groups))
+    group_var = np.empty(len(all_groups))
+    for idx, group in enumerate(tpi_groups.values()):
+        values = group['TPI'].to_numpy()
+        weights = group['Weight'].to_numpy()
+        group_n[idx] = len(values)
+        group_mean[idx] = np.average(values, weights=weights)
+        group_var[idx] = np.average((values - group_mean[idx]) ** 2, weights=weights)
+
+    pair_i, pair_j = np.triu_indices(len(all_groups), k=1)
+    t_stat, se, df = weighted_pair_statistics(group_n, group_mean, group_var, pair_i, pair_j)
+    # Conservative df = min(n1, n2) - 1; identical groups (zero SE) are not different
+    p_values = np.where(se == 0, 1.0, 2 * stats.t.sf(np.abs(t_stat), df))
+
+    p_matrix = np.ones((len(all_groups), len(all_groups)))
+    p_matrix[pair_i, pair_j] = p_values
+    p_matrix[pair_j, pair_i] = p_values
+    comprehensive_matrix = pd.DataFrame(p_matrix, index=all_groups, columns=all_groups)
+    results.extend(f"{all_groups[i]} vs {all_groups[j]}: p-value = {p_value:.6f}"
+                   for i, j, p_value in zip(pair_i, pair_j, p_values))
 
     results.extend([
         "\nComprehensive P-value Matrix:",
@@ -3187,7 +3606,7 @@ def main():
     output_dir.mkdir(exist_ok=True)
 
     logger.info("Loading metadata...")
-    metadata_df = pd.read_csv(metadata_file)
+    metadata_df = pd.read_csv(metadata_file, usecols=is_tpi_column, dtype=METADATA_DTYPES, engine='c')
 
     logger.info("Creating TPI plots...")
     create_tpi_plots(metadata_df, output_dir)